@@ -0,0 +1,363 @@
+"""Offline load test for main.py.
+
+Runs the app under uvicorn against local stand-ins for ElevenLabs and the Telegram Bot API,
+drives a few realistic scenarios and writes throughput and latency percentiles per endpoint
+to a JSON file:
+
+    python bench.py --workers 2 --output bench.json
+    python bench.py --baseline bench.json   # exit code 1 if anything regressed
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import httpx
+import uvicorn
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# === Upstream stand-ins ===
+# One MPEG-1 Layer III frame header: 128 kbit/s, 44.1 kHz, joint stereo, no padding -> 417 bytes.
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x64]) + bytes(413)
+
+def fake_mp3(text: str) -> bytes:
+    # Roughly one second of audio (38 frames) per 15 characters, like real speech.
+    return MP3_FRAME * max(1, len(text) * 38 // 15)
+
+def make_stub_app(args) -> FastAPI:
+    stub = FastAPI()
+    stub.state.calls = Counter()
+
+    async def upstream_delay(mean_ms: float):
+        if mean_ms > 0:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * mean_ms / 1000)
+
+    def injected_failure(kind: str):
+        roll = random.random()
+        if roll < args.rate_limit_rate:
+            stub.state.calls[f"{kind}:429"] += 1
+            return JSONResponse({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                 "parameters": {"retry_after": 1}}, status_code=429)
+        if roll < args.rate_limit_rate + args.error_rate:
+            stub.state.calls[f"{kind}:500"] += 1
+            return JSONResponse({"ok": False, "error_code": 500}, status_code=500)
+        return None
+
+    @stub.post("/v1/text-to-speech/{voice_id}")
+    async def tts(voice_id: str, request: Request):
+        body = await request.json()
+        await upstream_delay(args.tts_latency)
+        failure = injected_failure("tts")
+        if failure:
+            return failure
+        stub.state.calls["tts"] += 1
+        stub.state.calls["tts_chars"] += len(body["text"])
+        return Response(content=fake_mp3(body["text"]), media_type="audio/mpeg")
+
+    @stub.post("/v1/text-to-speech/{voice_id}/stream")
+    async def tts_stream(voice_id: str, request: Request):
+        body = await request.json()
+        await upstream_delay(args.tts_latency / 4)  # time to first byte
+        failure = injected_failure("tts")
+        if failure:
+            return failure
+        stub.state.calls["tts_stream"] += 1
+        stub.state.calls["tts_chars"] += len(body["text"])
+        audio = fake_mp3(body["text"])
+
+        async def chunks():
+            step = len(audio) // 4 + 1
+            for i in range(0, len(audio), step):
+                yield audio[i:i + step]
+                await upstream_delay(args.tts_latency / 4)
+
+        return StreamingResponse(chunks(), media_type="audio/mpeg")
+
+    @stub.post("/bot{token}/{method}")
+    async def telegram(token: str, method: str, request: Request):
+        if method == "getUpdates":
+            await asyncio.sleep(1)
+            return {"ok": True, "result": []}
+        await upstream_delay(args.tg_latency)
+        failure = injected_failure("telegram")
+        if failure:
+            return failure
+        stub.state.calls[f"telegram:{method}"] += 1
+        return {"ok": True, "result": {"message_id": 1}}
+
+    return stub
+
+# === Harness ===
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def start_stub(args):
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(make_stub_app(args), host="127.0.0.1", port=port,
+                                           log_level="warning", access_log=False))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task, f"http://127.0.0.1:{port}"
+
+def start_app(args, stub_url: str, workdir: str):
+    port = free_port()
+    env = {
+        **os.environ,
+        "ELEVEN_LABS_API_URL": stub_url,
+        "TELEGRAM_API_URL": stub_url,
+        "ELEVEN_LABS_API_KEY": "bench",
+        "VOICE_ID": "bench",
+        "BOT_TOKEN": "bench",
+        "DB_PATH": os.path.join(workdir, "parties.db"),
+        "AUDIO_CACHE_DIR": os.path.join(workdir, "audio_cache"),
+        "WEB_CONCURRENCY": str(args.workers),  # tells the app it shares its state with other processes
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env=env,
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+async def wait_ready(client: httpx.AsyncClient, process, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app exited with code {process.returncode}")
+        try:
+            if (await client.get("/api/stats")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("app did not become ready")
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    async def call(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str,
+                   accept: tuple = (404,), **kwargs):
+        """Time one request; 4xx statuses in `accept` are expected answers, not errors."""
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            await response.aread()
+            ok = response.status_code < 400 or response.status_code in accept
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        if not ok:
+            self.errors[endpoint] += 1
+        return response
+
+    def summary(self, duration: float) -> dict:
+        endpoints = {}
+        for endpoint, samples in sorted(self.latencies.items()):
+            samples.sort()
+            endpoints[endpoint] = {
+                "count": len(samples),
+                "errors": self.errors[endpoint],
+                "rps": round(len(samples) / duration, 2) if duration else 0.0,
+                "p50_ms": round(percentile(samples, 50) * 1000, 2),
+                "p95_ms": round(percentile(samples, 95) * 1000, 2),
+                "p99_ms": round(percentile(samples, 99) * 1000, 2),
+                "max_ms": round(samples[-1] * 1000, 2),
+            }
+        return {"duration_s": round(duration, 3), "endpoints": endpoints}
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples) - 1, round(pct / 100 * len(samples) + 0.5) - 1))
+    return samples[rank]
+
+async def bounded(concurrency: int, jobs):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with semaphore:
+            await job
+
+    await asyncio.gather(*(run(job) for job in jobs))
+
+# === Scenarios ===
+GUEST_NAMES = ["Аня", "Петя", "Маша", "Ваня", "Соня", "Миша", "Лиза", "Артём", "Даша", "Егор",
+               "Алиса", "Макар", "Вера", "Тимур", "Ева", "Лев", "Полина", "Марк", "Ника", "Федя"]
+KID_NAMES = ["Миша", "Катя", "Саша", "Оля", "Дима", "Таня", "Гоша", "Юля"]
+
+async def party_burst(client, recorder, args, state):
+    async def create(i):
+        guests = random.sample(GUEST_NAMES, args.guests)
+        kid = random.choice(KID_NAMES)
+        response = await recorder.call(client, "POST /api/party", "POST", "/api/party",
+                                       json={"birthday_kid": kid, "guests": guests, "tg_id": 1000 + i})
+        if response is not None and response.status_code == 200:
+            state["parties"].append((response.json()["party_id"], kid, guests))
+
+    await bounded(args.concurrency, [create(i) for i in range(args.parties)])
+
+async def start_flood(client, recorder, args, state):
+    update_ids = iter(range(1, 10 ** 9))
+
+    def update(text: str, chat_id: int) -> dict:
+        return {"update_id": next(update_ids),
+                "message": {"chat": {"id": chat_id}, "from": {"id": chat_id}, "text": text}}
+
+    updates = []
+    for i in range(args.updates):
+        if state["parties"] and random.random() < 0.8:
+            text = f"/start {random.choice(state['parties'])[0]}"
+        elif random.random() < 0.5:
+            text = f"/start {os.urandom(4).hex()}"  # probes for unknown parties
+        else:
+            text = "/start"
+        updates.append(update(text, 5000 + i % 200))
+    # Telegram redelivers when we are slow; replay a tenth of the updates.
+    updates += random.sample(updates, len(updates) // 10)
+
+    await bounded(args.concurrency, [
+        recorder.call(client, "POST /webhook", "POST", "/webhook", json=u) for u in updates
+    ])
+
+async def party_reads(client, recorder, args, state):
+    ids = [p[0] for p in state["parties"]] or ["missing"]
+    await bounded(args.concurrency, [
+        recorder.call(client, "GET /api/party/{party_id}", "GET", f"/api/party/{random.choice(ids)}")
+        for _ in range(args.reads)
+    ])
+
+async def guest_claims(client, recorder, args, state):
+    # What the Mini App does when a guest taps their name: one claim-and-render round trip.
+    # A second device tapping a name someone else already took gets a 409, which is expected.
+    async def guest(party_id: str, name: str, tg_id: int):
+        stream = random.random() < 0.5
+        endpoint = "POST /api/claim-and-render" + (" (stream)" if stream else "")
+        await recorder.call(client, endpoint, "POST", "/api/claim-and-render", accept=(404, 409),
+                            json={"party_id": party_id, "guest_name": name, "tg_id": tg_id, "stream": stream})
+
+    jobs = []
+    for party_id, kid, guests in state["parties"]:
+        for name in guests:
+            # Several devices in the group chat open the same invite at once.
+            for device in range(random.choice([1, 1, 2, 3])):
+                jobs.append(guest(party_id, name, random.randint(1, 10 ** 6)))
+    random.shuffle(jobs)
+    await bounded(args.concurrency, jobs)
+
+SCENARIOS = {
+    "party_burst": party_burst,
+    "start_flood": start_flood,
+    "party_reads": party_reads,
+    "guest_claims": guest_claims,
+}
+
+# === Reporting ===
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for scenario, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(scenario, {}).get("endpoints", {})
+        for endpoint, now in current["endpoints"].items():
+            before = previous.get(endpoint)
+            if not before:
+                continue
+            if before["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + threshold):
+                regressions.append(f"{scenario} {endpoint}: p95 {before['p95_ms']} -> {now['p95_ms']} ms")
+            if before["rps"] and now["rps"] < before["rps"] * (1 - threshold):
+                regressions.append(f"{scenario} {endpoint}: rps {before['rps']} -> {now['rps']}")
+            if now["errors"] > before["errors"] * (1 + threshold) + 1:
+                regressions.append(f"{scenario} {endpoint}: errors {before['errors']} -> {now['errors']}")
+    return regressions
+
+def print_summary(results: dict):
+    print(f"{'scenario':<14} {'endpoint':<34} {'count':>6} {'err':>5} {'rps':>9} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for scenario, summary in results["scenarios"].items():
+        for endpoint, row in summary["endpoints"].items():
+            print(f"{scenario:<14} {endpoint:<34} {row['count']:>6} {row['errors']:>5} {row['rps']:>9} "
+                  f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+    print("upstream calls:", dict(results["upstream"]))
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    stub_server, stub_task, stub_url = await start_stub(args)
+    workdir = tempfile.mkdtemp(prefix="rocky-bench-")
+    process, app_url = start_app(args, stub_url, workdir)
+    results = {"meta": {"workers": args.workers, "concurrency": args.concurrency, "parties": args.parties,
+                        "guests": args.guests, "tts_latency_ms": args.tts_latency,
+                        "tg_latency_ms": args.tg_latency, "error_rate": args.error_rate,
+                        "rate_limit_rate": args.rate_limit_rate, "env": args.env,
+                        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+               "scenarios": {}}
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=60.0) as client:
+            await wait_ready(client, process)
+            state = {"parties": []}
+            for name in args.scenarios:
+                recorder = Recorder()
+                started = time.perf_counter()
+                await SCENARIOS[name](client, recorder, args, state)
+                results["scenarios"][name] = recorder.summary(time.perf_counter() - started)
+            await asyncio.sleep(args.settle)  # let queued webhooks and sends drain
+            results["app_stats"] = (await client.get("/api/stats")).json()
+        results["upstream"] = dict(stub_server.config.app.state.calls)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        stub_server.should_exit = True
+        await stub_task
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes for the app")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent client requests")
+    parser.add_argument("--parties", type=int, default=50)
+    parser.add_argument("--guests", type=int, default=8, help="guests per party")
+    parser.add_argument("--updates", type=int, default=2000, help="webhook updates in start_flood")
+    parser.add_argument("--reads", type=int, default=2000, help="requests in party_reads")
+    parser.add_argument("--tts-latency", type=float, default=800.0, help="mean ElevenLabs latency, ms")
+    parser.add_argument("--tg-latency", type=float, default=60.0, help="mean Telegram latency, ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream calls failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of upstream calls answered 429")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait before reading /api/stats")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app environment")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print_summary(results)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
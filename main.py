@@ -1,75 +1,1667 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, Response, JSONResponse
+from fastapi.responses import HTMLResponse, Response, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 import httpx
+import gzip
+import asyncio
+import bisect
+import codecs
+import csv
+import fcntl
+import hashlib
+import hmac
+import importlib.util
+import json
+import logging
 import os
+import queue
+import random
 import sqlite3
+import sys
+import threading
+import time
+import unicodedata
 import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # === Config ===
 ELEVEN_LABS_API_KEY = os.getenv("ELEVEN_LABS_API_KEY")
 VOICE_ID = os.getenv("VOICE_ID")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 APP_URL = os.getenv("APP_URL", "https://rocky-production-4c4f.up.railway.app")
+ELEVEN_LABS_API_URL = os.getenv("ELEVEN_LABS_API_URL", "https://api.elevenlabs.io")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+# Worker processes sharing DB_PATH. uvicorn uses it as the --workers default, so set it instead of
+# the flag; lock_processes refuses to start several processes that were not told about each other.
+WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+DB_PATH = os.getenv("DB_PATH", "parties.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_MEMORY_BYTES = int(os.getenv("AUDIO_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+AUDIO_CACHE_DISK_BYTES = int(os.getenv("AUDIO_CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024))
+AUDIO_CACHE_MAX_AGE = float(os.getenv("AUDIO_CACHE_MAX_AGE", 30 * 24 * 3600))
+
+# Coalesces renders across worker processes; on by default when there is more than one.
+SYNTHESIS_LOCK_DIR = os.getenv("SYNTHESIS_LOCK_DIR", os.path.join(AUDIO_CACHE_DIR, "locks") if WORKERS > 1 else "")
+PRERENDER_WORKERS = int(os.getenv("PRERENDER_WORKERS", 4))
+ELEVEN_LABS_RATE = float(os.getenv("ELEVEN_LABS_RATE", 2.0))  # requests per second per API key, all workers
+ELEVEN_LABS_BURST = int(os.getenv("ELEVEN_LABS_BURST", 4))
+
+HTTP2 = os.getenv("HTTP2", "0") == "1"  # needs the optional `h2` package
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 50))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60.0))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5.0))
+ELEVEN_LABS_TIMEOUT = float(os.getenv("ELEVEN_LABS_TIMEOUT", 30.0))
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", 10.0))
+
+PARTY_CACHE_SIZE = int(os.getenv("PARTY_CACHE_SIZE", 10000))
+PARTY_CACHE_TTL = float(os.getenv("PARTY_CACHE_TTL", 300))
+PARTY_CACHE_NEGATIVE_TTL = float(os.getenv("PARTY_CACHE_NEGATIVE_TTL", 30))
+# How often a worker picks up the other workers' writes; 0 (the single-process default) disables it.
+PARTY_CACHE_SYNC_INTERVAL = float(os.getenv("PARTY_CACHE_SYNC_INTERVAL", 1.0 if WORKERS > 1 else 0))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30.0))  # messages per second, all chats and workers
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1.0))  # messages per second, one chat
+TELEGRAM_SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", 8))
+TELEGRAM_SEND_ATTEMPTS = int(os.getenv("TELEGRAM_SEND_ATTEMPTS", 5))
+# Persist pending sends in SQLite; with several workers this is how they share the queue.
+TELEGRAM_OUTBOX = os.getenv("TELEGRAM_OUTBOX", "1" if WORKERS > 1 else "0") == "1"
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", 60))  # a dead worker's sends are retried after this
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # the secret_token passed to setWebhook
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", 2.0))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", 10000))
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", 24 * 3600))  # seen update_ids kept in SQLite with several workers
+TELEGRAM_POLLING = os.getenv("TELEGRAM_POLLING", "0") == "1"  # getUpdates instead of the webhook, for local runs
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", 30))
+
+SLOW_REQUEST_PROFILE_MS = float(os.getenv("SLOW_REQUEST_PROFILE_MS", 0))  # 0 disables the sampling profiler
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 10))
+
+SPLICED_AUDIO = os.getenv("SPLICED_AUDIO", "0") == "1"  # synthesize only the name fragments
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 500))  # parties per transaction in streamed imports
+IMPORT_MAX_LINE = 1024 * 1024
+BOT_USERNAME = "RockyHelloParkBot"
+
+TTS_MODEL_ID = "eleven_multilingual_v2"
+TTS_VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.75}
+
+logger = logging.getLogger("rocky")
+
+# === Metrics ===
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class CounterMetric:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = Counter()
+
+    def inc(self, *labels, amount: float = 1):
+        # Label values are text on the wire; keeping them as str also keeps `render` sortable
+        # when one label sees both 429 and "error".
+        self.values[tuple(map(str, labels))] += amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class HistogramMetric:
+    def __init__(self, name: str, help: str, labels: tuple = (),
+                 buckets: tuple = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        labels = tuple(map(str, labels))
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for labels, series in sorted(self.series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {total}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {total}")
+        return lines
+
+http_request_seconds = HistogramMetric(
+    "rocky_http_request_seconds", "Time to answer an HTTP request, including the body.", ("method", "route"))
+http_responses_total = CounterMetric(
+    "rocky_http_responses_total", "HTTP responses by status code.", ("method", "route", "status"))
+upstream_request_seconds = HistogramMetric(
+    "rocky_upstream_request_seconds", "Duration of calls to ElevenLabs and Telegram.", ("upstream", "operation"))
+upstream_responses_total = CounterMetric(
+    "rocky_upstream_responses_total", "Upstream responses by status code (or \"error\").",
+    ("upstream", "operation", "status"))
+db_call_seconds = HistogramMetric(
+    "rocky_db_call_seconds", "Duration of data-layer calls, including waiting for a pooled connection.",
+    ("function",), buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+slow_requests_total = CounterMetric(
+    "rocky_slow_requests_total", "Requests slower than SLOW_REQUEST_PROFILE_MS.", ("method", "route"))
+
+def render_stats_gauges(stats: dict) -> list:
+    """Expose every number from `collect_stats()` as a gauge, e.g. rocky_audio_cache_memory_bytes."""
+    lines = []
+    for section, values in stats.items():
+        rows = {(): values}
+        if values and all(isinstance(v, dict) for v in values.values()):
+            rows = {(name,): v for name, v in values.items()}
+        for field in sorted({f for row in rows.values() for f in row}):
+            name = f"rocky_{section}_{field}"
+            samples = [(labels, row[field]) for labels, row in rows.items()
+                       if isinstance(row.get(field), (int, float))]
+            if not samples:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(('name',) if labels else (), labels)} {float(value)}")
+    return lines
+
+class SlowRequestProfiler:
+    """Opt-in sampler of the event loop thread's stack, reported for requests over a threshold.
+
+    A daemon thread records one stack every `interval` seconds, only while requests are in
+    flight. All requests share the loop, so a report shows what the loop was busy with while
+    the slow request was open - its own work and whatever delayed it.
+    """
+
+    def __init__(self, threshold: float, interval: float, max_samples: int = 10000):
+        self.threshold = threshold
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)  # (monotonic time, stack)
+        self.active = 0
+        self._loop_thread = None
+        self._thread = None
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._thread = threading.Thread(target=self._sample, name="slow-request-profiler", daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = []
+            while frame is not None and len(stack) < 40:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno}:{code.co_name}")
+                frame = frame.f_back
+            self.samples.append((time.monotonic(), tuple(stack)))
+
+    def report(self, method: str, route: str, started: float, duration: float):
+        finished = started + duration
+        stacks = Counter(stack for at, stack in list(self.samples) if started <= at <= finished)
+        total = sum(stacks.values())
+        lines = [f"Slow request {method} {route}: {duration * 1000:.0f} ms, {total} loop samples"]
+        for stack, count in stacks.most_common(5):
+            lines.append(f"  {count / total:5.1%}  " + " <- ".join(stack[:8]))
+        logger.warning("\n".join(lines))
+
+profiler = SlowRequestProfiler(SLOW_REQUEST_PROFILE_MS / 1000, PROFILE_INTERVAL_MS / 1000) \
+    if SLOW_REQUEST_PROFILE_MS > 0 else None
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing every HTTP request by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.monotonic()
+        if profiler is not None:
+            profiler.active += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.monotonic() - started
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            http_request_seconds.observe(duration, method, route)
+            http_responses_total.inc(method, route, status)
+            if profiler is not None:
+                profiler.active -= 1
+                if duration >= profiler.threshold:
+                    slow_requests_total.inc(method, route)
+                    profiler.report(method, route, started, duration)
 
 # === Database ===
+class Database:
+    """Fixed pool of SQLite connections used from a dedicated thread pool.
+
+    Queries never run on the event loop: `run` hands a function to one of the pool threads
+    together with a connection. Connections stay open for the life of the process, so
+    sqlite3's per-connection statement cache keeps the prepared statements warm.
+
+    Several worker processes can share the file: WAL lets readers run alongside the single
+    writer, and `write` transactions queue for the write lock under the busy timeout.
+    """
+
+    def __init__(self, path: str, pool_size: int, busy_timeout_ms: int):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connections = queue.SimpleQueue()
+        self._executor = None
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000,
+                               check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        return conn
+
+    def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="sqlite")
+        for _ in range(self.pool_size):
+            self._connections.put(self.connect())
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        while not self._connections.empty():
+            self._connections.get().close()
+
+    def _call(self, fn, args, immediate):
+        conn = self._connections.get()
+        try:
+            if immediate:
+                # A deferred transaction that reads before it writes gets SQLITE_BUSY, without
+                # waiting, if another process committed in between; take the write lock up front.
+                conn.execute("BEGIN IMMEDIATE")
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._connections.put(conn)
+
+    async def _run(self, fn, args, immediate):
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args, immediate)
+        finally:
+            db_call_seconds.observe(time.monotonic() - started, fn.__name__.lstrip("_"))
+
+    async def run(self, fn, *args):
+        """Run `fn(conn, *args)` in its own transaction on a pooled connection."""
+        return await self._run(fn, args, False)
+
+    async def write(self, fn, *args):
+        """Like `run`, for functions that write: the transaction starts with BEGIN IMMEDIATE."""
+        return await self._run(fn, args, True)
+
+    def stats(self) -> dict:
+        return {"pool_size": self.pool_size, "idle_connections": self._connections.qsize()}
+
+db = Database(DB_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT_MS)
+
+def lock_processes(wait: float = 10.0) -> tuple:
+    """Refuse to share the database with a process that keeps its state in memory.
+
+    A single-process deployment (WEB_CONCURRENCY unset or 1) holds `<db>.processes.lock`
+    exclusively; workers of a multi-process one hold it shared. So `uvicorn --workers N`
+    without WEB_CONCURRENCY fails here instead of running N processes with unshared caches,
+    queues and dedup. Returns the descriptor to keep open while serving and whether no other
+    process was serving when this one started, in which case work they left unfinished is ours.
+    """
+    fd = os.open(f"{db.path}.processes.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if WORKERS > 1:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        return fd, True
+    except BlockingIOError:
+        pass
+    mode = fcntl.LOCK_SH if WORKERS > 1 else fcntl.LOCK_EX
+    deadline = time.monotonic() + wait  # a previous process may still be shutting down
+    while True:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return fd, mode == fcntl.LOCK_EX
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                os.close(fd)
+                raise RuntimeError(
+                    f"Another process is serving from {db.path} in a different mode. To run several "
+                    f"workers, set WEB_CONCURRENCY to their number (uvicorn uses it as the --workers "
+                    f"default) so every worker shares its state through the database.") from None
+            time.sleep(0.2)
+
+SCHEMA_MIGRATIONS = [
+    # 1: the original schema, which predates user_version
+    ['''CREATE TABLE IF NOT EXISTS parties
+        (id TEXT PRIMARY KEY, birthday_kid TEXT, created_by_tg_id INTEGER,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+     '''CREATE TABLE IF NOT EXISTS guests
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, party_id TEXT, name TEXT,
+         claimed_by_tg_id INTEGER, claimed_at TIMESTAMP,
+         FOREIGN KEY (party_id) REFERENCES parties(id))''',
+     "CREATE INDEX IF NOT EXISTS idx_guests_party_name ON guests (party_id, name)",
+     '''CREATE TABLE IF NOT EXISTS outbox
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, payload TEXT,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'''],
+    # 2: state shared between worker processes
+    ["ALTER TABLE outbox ADD COLUMN leased_by TEXT",
+     "ALTER TABLE outbox ADD COLUMN lease_until REAL",
+     "CREATE INDEX idx_outbox_lease ON outbox (lease_until)",
+     "CREATE TABLE seen_updates (update_id INTEGER PRIMARY KEY, seen_at REAL)",
+     "CREATE INDEX idx_seen_updates_seen_at ON seen_updates (seen_at)",
+     '''CREATE TABLE cache_invalidations
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, party_id TEXT, worker_id TEXT, created_at REAL)'''],
+    # 3: pre-render progress, so any worker can report it
+    ["""CREATE TABLE prerender_progress
+        (party_id TEXT PRIMARY KEY, total INTEGER, ready INTEGER DEFAULT 0, failed INTEGER DEFAULT 0)"""],
+]
+
 def init_db():
-    conn = sqlite3.connect('parties.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS parties
-                 (id TEXT PRIMARY KEY, birthday_kid TEXT, created_by_tg_id INTEGER,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS guests
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, party_id TEXT, name TEXT,
-                  claimed_by_tg_id INTEGER, claimed_at TIMESTAMP,
-                  FOREIGN KEY (party_id) REFERENCES parties(id))''')
-    conn.commit()
-    conn.close()
-
-def create_party(party_id: str, birthday_kid: str, guests: list, tg_id: int):
-    conn = sqlite3.connect('parties.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO parties (id, birthday_kid, created_by_tg_id) VALUES (?, ?, ?)",
-              (party_id, birthday_kid, tg_id))
-    for guest in guests:
-        c.execute("INSERT INTO guests (party_id, name) VALUES (?, ?)", (party_id, guest))
-    conn.commit()
-    conn.close()
-
-def get_party(party_id: str):
-    conn = sqlite3.connect('parties.db')
-    c = conn.cursor()
-    c.execute("SELECT birthday_kid FROM parties WHERE id = ?", (party_id,))
-    party = c.fetchone()
+    """Apply pending SCHEMA_MIGRATIONS. Workers take turns on a lock file, so only the first one migrates."""
+    with open(f"{db.path}.init.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        conn = db.connect()
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            for version, statements in enumerate(SCHEMA_MIGRATIONS[current:], start=current + 1):
+                conn.execute("BEGIN IMMEDIATE")
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+                logger.info("Migrated %s to schema version %d", db.path, version)
+        finally:
+            conn.close()
+
+def _create_parties(conn: sqlite3.Connection, parties: list):
+    """Insert `(party_id, birthday_kid, guests, tg_id)` tuples with two bulk statements."""
+    conn.executemany("INSERT INTO parties (id, birthday_kid, created_by_tg_id) VALUES (?, ?, ?)",
+                     [(party_id, birthday_kid, tg_id) for party_id, birthday_kid, _, tg_id in parties])
+    conn.executemany("INSERT INTO guests (party_id, name) VALUES (?, ?)",
+                     [(party_id, guest) for party_id, _, guests, _ in parties for guest in guests])
+    conn.executemany("INSERT INTO prerender_progress (party_id, total) VALUES (?, ?)",
+                     [(party_id, len(guests)) for party_id, _, guests, _ in parties])
+    _publish_invalidations(conn, [party_id for party_id, *_ in parties])
+
+def _get_party(conn: sqlite3.Connection, party_id: str):
+    party = conn.execute("SELECT birthday_kid FROM parties WHERE id = ?", (party_id,)).fetchone()
     if not party:
-        conn.close()
         return None
-    c.execute("SELECT name, claimed_by_tg_id FROM guests WHERE party_id = ?", (party_id,))
-    guests = [{"name": row[0], "claimed": row[1] is not None} for row in c.fetchall()]
-    conn.close()
+    rows = conn.execute("SELECT name, claimed_by_tg_id FROM guests WHERE party_id = ?", (party_id,)).fetchall()
+    guests = [{"name": row[0], "claimed": row[1] is not None} for row in rows]
     return {"birthday_kid": party[0], "guests": guests}
 
-def claim_guest(party_id: str, guest_name: str, tg_id: int):
-    conn = sqlite3.connect('parties.db')
-    c = conn.cursor()
-    c.execute("""UPDATE guests SET claimed_by_tg_id = ?, claimed_at = CURRENT_TIMESTAMP 
-                 WHERE party_id = ? AND name = ? AND claimed_by_tg_id IS NULL""",
-              (tg_id, party_id, guest_name))
-    conn.commit()
-    conn.close()
+def _claim_guest(conn: sqlite3.Connection, party_id: str, guest_name: str, tg_id: int) -> str:
+    """Claim a guest name; returns "claimed", "already_claimed" (by this user), "taken" or "not_found"."""
+    cursor = conn.execute("""UPDATE guests SET claimed_by_tg_id = ?, claimed_at = CURRENT_TIMESTAMP
+                             WHERE party_id = ? AND name = ? AND claimed_by_tg_id IS NULL""",
+                          (tg_id, party_id, guest_name))
+    if cursor.rowcount > 0:
+        _publish_invalidations(conn, [party_id])
+        return "claimed"
+    # Same transaction as the UPDATE, so this sees the row exactly as the UPDATE did.
+    row = conn.execute("SELECT claimed_by_tg_id FROM guests WHERE party_id = ? AND name = ?",
+                       (party_id, guest_name)).fetchone()
+    if row is None:
+        return "not_found"
+    return "already_claimed" if row[0] == tg_id else "taken"
+
+def _get_parties(conn: sqlite3.Connection, party_ids: list) -> dict:
+    found = {}
+    for i in range(0, len(party_ids), 500):  # stay under SQLite's host parameter limit
+        chunk = party_ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        for party_id, birthday_kid in conn.execute(
+                f"SELECT id, birthday_kid FROM parties WHERE id IN ({marks})", chunk):
+            found[party_id] = {"birthday_kid": birthday_kid, "guests": []}
+        for party_id, name, claimed_by in conn.execute(
+                f"SELECT party_id, name, claimed_by_tg_id FROM guests WHERE party_id IN ({marks}) ORDER BY id", chunk):
+            found[party_id]["guests"].append({"name": name, "claimed": claimed_by is not None})
+    return {party_id: found.get(party_id) for party_id in party_ids}
+
+def _claim_guests(conn: sqlite3.Connection, claims: list) -> list:
+    return [_claim_guest(conn, party_id, guest_name, tg_id) for party_id, guest_name, tg_id in claims]
+
+def _count_prerender(conn: sqlite3.Connection, party_id: str, field: str):
+    assert field in ("ready", "failed")
+    conn.execute(f"UPDATE prerender_progress SET {field} = {field} + 1 WHERE party_id = ?", (party_id,))
+
+def _restart_prerenders(conn: sqlite3.Connection) -> list:
+    """Zero the progress of unfinished pre-renders; returns `(party_id, birthday_kid, guests)` to render again."""
+    party_ids = [row[0] for row in conn.execute(
+        "SELECT party_id FROM prerender_progress WHERE ready + failed < total")]
+    conn.execute("UPDATE prerender_progress SET ready = 0, failed = 0 WHERE ready + failed < total")
+    parties = []
+    for party_id in party_ids:
+        party = _get_party(conn, party_id)
+        if party is not None:
+            parties.append((party_id, party["birthday_kid"], [guest["name"] for guest in party["guests"]]))
+    return parties
+
+def _get_prerender_progress(conn: sqlite3.Connection, party_ids: list) -> dict:
+    found = {}
+    for i in range(0, len(party_ids), 500):  # stay under SQLite's host parameter limit
+        chunk = party_ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        for party_id, total, ready, failed in conn.execute(
+                f"SELECT party_id, total, ready, failed FROM prerender_progress WHERE party_id IN ({marks})", chunk):
+            found[party_id] = {"total": total, "ready": ready, "failed": failed}
+    return found
+
+def _publish_invalidations(conn: sqlite3.Connection, party_ids: list):
+    """Tell the other workers' party caches about a write, inside the writer's transaction."""
+    if party_cache.shared:
+        now = time.time()
+        conn.executemany("INSERT INTO cache_invalidations (party_id, worker_id, created_at) VALUES (?, ?, ?)",
+                         [(party_id, WORKER_ID, now) for party_id in party_ids])
+
+def _last_invalidation(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations").fetchone()[0]
+
+def _read_invalidations(conn: sqlite3.Connection, after_id: int) -> list:
+    return conn.execute("SELECT id, party_id, worker_id FROM cache_invalidations WHERE id > ? ORDER BY id",
+                        (after_id,)).fetchall()
+
+def _prune_invalidations(conn: sqlite3.Connection, before: float):
+    conn.execute("DELETE FROM cache_invalidations WHERE created_at < ?", (before,))
+
+class PartyCache:
+    """LRU of party views with a TTL, including short-lived entries for unknown party IDs.
+
+    Writers call `invalidate` after committing. A read that raced with a write is not cached:
+    `put` is dropped if any invalidation happened since the read's `generation` was taken.
+
+    With `sync_interval` set, writes also leave a row in `cache_invalidations`, which every
+    worker polls, so another process serves a stale party for at most about that long.
+    """
+
+    retention = 60.0  # seconds invalidation rows are kept for workers that fall behind
+
+    def __init__(self, max_entries: int, ttl: float, negative_ttl: float, sync_interval: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.sync_interval = sync_interval
+        self._entries = OrderedDict()  # party_id -> (party or None, expires_at)
+        self.generation = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.remote_invalidations = 0
+        self.evictions = 0
+        self._last_invalidation_id = 0
+        self._task = None
+
+    @property
+    def shared(self) -> bool:
+        return self.sync_interval > 0
+
+    async def start(self):
+        if self.shared:
+            self._last_invalidation_id = await db.run(_last_invalidation)
+            self._task = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sync(self):
+        synced_at = pruned_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                rows = await db.run(_read_invalidations, self._last_invalidation_id)
+                now = time.monotonic()
+                if now - synced_at > self.retention / 2:
+                    # Rows we never saw may have been pruned already; start over rather than guess.
+                    self.clear()
+                synced_at = now
+                for invalidation_id, party_id, worker_id in rows:
+                    self._last_invalidation_id = invalidation_id
+                    if worker_id != WORKER_ID:
+                        self.invalidate(party_id)
+                        self.remote_invalidations += 1
+                if now - pruned_at > self.retention:
+                    await db.write(_prune_invalidations, time.time() - self.retention)
+                    pruned_at = now
+            except sqlite3.Error as e:
+                logger.warning("Party cache sync failed: %r", e)
+
+    def get(self, party_id: str):
+        """Return `(hit, party)`; a hit with `party=None` means the ID is known not to exist."""
+        entry = self._entries.get(party_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(party_id)
+        if entry[0] is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, entry[0]
+
+    def put(self, party_id: str, party, generation: int):
+        if generation != self.generation or self.max_entries <= 0:
+            return
+        ttl = self.ttl if party is not None else self.negative_ttl
+        self._entries[party_id] = (party, time.monotonic() + ttl)
+        self._entries.move_to_end(party_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, party_id: str):
+        self.generation += 1
+        self.invalidations += 1
+        self._entries.pop(party_id, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "remote_invalidations": self.remote_invalidations,
+            "evictions": self.evictions,
+            "shared": self.shared,
+        }
+
+party_cache = PartyCache(PARTY_CACHE_SIZE, PARTY_CACHE_TTL, PARTY_CACHE_NEGATIVE_TTL, PARTY_CACHE_SYNC_INTERVAL)
+
+async def create_parties(parties: list):
+    await db.write(_create_parties, parties)
+    for party_id, *_ in parties:
+        party_cache.invalidate(party_id)
+
+async def create_party(party_id: str, birthday_kid: str, guests: list, tg_id: int):
+    await create_parties([(party_id, birthday_kid, guests, tg_id)])
+
+async def get_party(party_id: str):
+    hit, party = party_cache.get(party_id)
+    if hit:
+        return party
+    generation = party_cache.generation
+    party = await db.run(_get_party, party_id)
+    party_cache.put(party_id, party, generation)
+    return party
+
+async def claim_guest(party_id: str, guest_name: str, tg_id: int) -> str:
+    result = await db.write(_claim_guest, party_id, guest_name, tg_id)
+    if result == "claimed":
+        party_cache.invalidate(party_id)
+    return result
+
+async def get_parties(party_ids: list) -> dict:
+    parties, missing = {}, []
+    for party_id in party_ids:
+        hit, party = party_cache.get(party_id)
+        if hit:
+            parties[party_id] = party
+        else:
+            missing.append(party_id)
+    if missing:
+        generation = party_cache.generation
+        for party_id, party in (await db.run(_get_parties, missing)).items():
+            party_cache.put(party_id, party, generation)
+            parties[party_id] = party
+    return {party_id: parties[party_id] for party_id in party_ids}
+
+async def claim_guests(claims: list) -> list:
+    results = await db.write(_claim_guests, claims)
+    for party_id in {claim[0] for claim, result in zip(claims, results) if result == "claimed"}:
+        party_cache.invalidate(party_id)
+    return results
+
+def _outbox_add(conn: sqlite3.Connection, chat_id: int, payload: str, worker_id: str, lease_until: float) -> int:
+    """Insert a send already leased to the worker that queued it, so no other worker picks it up."""
+    return conn.execute("INSERT INTO outbox (chat_id, payload, leased_by, lease_until) VALUES (?, ?, ?, ?)",
+                        (chat_id, payload, worker_id, lease_until)).lastrowid
+
+def _outbox_delete(conn: sqlite3.Connection, outbox_id: int):
+    conn.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+
+def _outbox_claim(conn: sqlite3.Connection, worker_id: str, expired_before: float, lease_until: float,
+                  limit: int) -> list:
+    """Lease up to `limit` sends whose lease ran out before `expired_before`, e.g. after their worker died."""
+    rows = conn.execute("""SELECT id, chat_id, payload FROM outbox
+                           WHERE lease_until IS NULL OR lease_until < ? ORDER BY id LIMIT ?""",
+                        (expired_before, limit)).fetchall()
+    conn.executemany("UPDATE outbox SET leased_by = ?, lease_until = ? WHERE id = ?",
+                     [(worker_id, lease_until, row[0]) for row in rows])
+    return rows
+
+def _outbox_release(conn: sqlite3.Connection):
+    """Drop every lease so the sends can be claimed again, e.g. ones leased by this process's previous run."""
+    conn.execute("UPDATE outbox SET leased_by = NULL, lease_until = NULL")
+
+def _outbox_renew(conn: sqlite3.Connection, outbox_id: int, worker_id: str, lease_until: float) -> bool:
+    """Extend our lease on a send; False if it expired and another worker has taken it over."""
+    return conn.execute("UPDATE outbox SET lease_until = ? WHERE id = ? AND leased_by = ?",
+                        (lease_until, outbox_id, worker_id)).rowcount > 0
+
+def _mark_update_seen(conn: sqlite3.Connection, update_id: int, expired_before: float) -> bool:
+    """Record `update_id`; False if a worker already has. Old IDs are pruned every 1000th update."""
+    if update_id % 1000 == 0:
+        conn.execute("DELETE FROM seen_updates WHERE seen_at < ?", (expired_before,))
+    return conn.execute("INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)",
+                        (update_id, time.time())).rowcount > 0
+
+def _forget_update(conn: sqlite3.Connection, update_id: int):
+    conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+
+# === Audio cache ===
+class AudioCache:
+    """Two-tier cache of synthesized MP3s: byte-bounded LRU in memory over a directory on disk.
+
+    Keys are content hashes of the full synthesis request (see `audio_cache_key`), so an entry
+    never has to be invalidated - it can only become too old or be pushed out by size.
+    """
+
+    def __init__(self, directory: str, max_memory_bytes: int, max_disk_bytes: int, max_age: float):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age = max_age
+        self._memory = OrderedDict()  # key -> (data, stored_at)
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size, least recently used first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self.expirations = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.mp3")
+
+    def load(self):
+        """Index what is already on disk, dropping expired files. Blocking - run in a thread."""
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith(".mp3"):
+                    continue
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if now - st.st_mtime > self.max_age:
+                    self._unlink(path)
+                    self.expirations += 1
+                    continue
+                found.append((st.st_mtime, name[:-4], st.st_size))
+        with self._lock:
+            for _, key, size in sorted(found):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def get_memory(self, key: str):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            data, stored_at = entry
+            if time.time() - stored_at > self.max_age:
+                self._drop_memory(key)
+                self.expirations += 1
+                return None
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return data
+
+    def get_disk(self, key: str):
+        """Look the key up on disk and promote it to memory. Blocking - run in a thread."""
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            if time.time() - st.st_mtime > self.max_age:
+                self._unlink(path)
+                with self._lock:
+                    self._forget_disk(key)
+                    self.expirations += 1
+                    self.misses += 1
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._forget_disk(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            else:
+                self._disk[key] = len(data)
+                self._disk_bytes += len(data)
+            self.disk_hits += 1
+            self._store_memory(key, data, st.st_mtime)
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Write an entry to both tiers. Blocking - run in a thread."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._forget_disk(key)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._evict_disk()
+            self._store_memory(key, data, time.time())
+
+    def _store_memory(self, key: str, data: bytes, stored_at: float):
+        if key in self._memory:
+            self._drop_memory(key)
+        if len(data) > self.max_memory_bytes:
+            return
+        self._memory[key] = (data, stored_at)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            oldest = next(iter(self._memory))
+            self._drop_memory(oldest)
+            self.memory_evictions += 1
+
+    def _drop_memory(self, key: str):
+        data, _ = self._memory.pop(key)
+        self._memory_bytes -= len(data)
+
+    def _forget_disk(self, key: str):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._unlink(self._path(key))
+            self.disk_evictions += 1
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_evictions": self.memory_evictions,
+                "disk_evictions": self.disk_evictions,
+                "expirations": self.expirations,
+            }
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MEMORY_BYTES, AUDIO_CACHE_DISK_BYTES, AUDIO_CACHE_MAX_AGE)
+
+async def get_cached_audio(key: str):
+    data = audio_cache.get_memory(key)
+    if data is None:
+        data = await asyncio.to_thread(audio_cache.get_disk, key)
+    return data
+
+# === HTTP clients ===
+class UpstreamClient:
+    """Long-lived keep-alive client for one upstream API, opened and closed by `lifespan`.
+
+    Requests queue on a semaphore sized like the connection pool, which lets us report how long
+    callers waited for a free connection.
+    """
+
+    def __init__(self, name: str, base_url: str, timeout: float):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = timeout
+        self.client = None
+        self.http2 = False
+        self._slots = None
+        self.requests = 0
+        self.active = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def open(self):
+        self.http2 = HTTP2 and importlib.util.find_spec("h2") is not None
+        if HTTP2 and not self.http2:
+            logger.warning("HTTP2=1 but the h2 package is not installed; %s uses HTTP/1.1", self.name)
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(self.timeout, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        self._slots = asyncio.Semaphore(HTTP_MAX_CONNECTIONS)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    @asynccontextmanager
+    async def _slot(self):
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        self.requests += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+    async def post(self, url: str, operation: str, **kwargs) -> httpx.Response:
+        started = time.monotonic()
+        status = "error"
+        try:
+            async with self._slot():
+                response = await self.client.post(url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            upstream_request_seconds.observe(time.monotonic() - started, self.name, operation)
+            upstream_responses_total.inc(self.name, operation, status)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, operation: str, **kwargs):
+        started = time.monotonic()
+        status = "error"
+        try:
+            async with self._slot():
+                async with self.client.stream(method, url, **kwargs) as response:
+                    status = response.status_code
+                    yield response
+        finally:
+            upstream_request_seconds.observe(time.monotonic() - started, self.name, operation)
+            upstream_responses_total.inc(self.name, operation, status)
+
+    def _connections(self) -> list:
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        return list(getattr(pool, "connections", []))
+
+    def stats(self) -> dict:
+        connections = self._connections()
+        return {
+            "http2": self.http2,
+            "requests": self.requests,
+            "active_requests": self.active,
+            "waiting_requests": self.waiting,
+            "connections": len(connections),
+            "idle_connections": sum(1 for c in connections if c.is_idle()),
+            "wait_seconds_total": round(self.wait_total, 6),
+            "wait_seconds_max": round(self.wait_max, 6),
+        }
+
+elevenlabs = UpstreamClient("elevenlabs", ELEVEN_LABS_API_URL, ELEVEN_LABS_TIMEOUT)
+telegram = UpstreamClient("telegram", TELEGRAM_API_URL, TELEGRAM_TIMEOUT)
+
+# === Request coalescing ===
+class FlightAbandoned(Exception):
+    """The leader gave up without a result (e.g. it was cancelled); followers should retry."""
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution whose result everyone shares.
+
+    With `lock_dir` set, leaders in different processes also serialize on a striped `flock`, so a
+    worker that loses the race can pick the finished artifact up from the shared disk cache.
+    """
+
+    lock_stripes = 4096
+
+    def __init__(self, lock_dir: str = ""):
+        self.lock_dir = lock_dir
+        self._flights = {}  # key -> Future
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared_hits = 0
+        self.lock_waits = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._flights
+
+    def lead(self, key: str, fn) -> asyncio.Future:
+        """Start `fn()` as the flight for `key`. The caller must have checked that none is running."""
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        self.leaders += 1
+        task = asyncio.create_task(fn())
+        task.add_done_callback(lambda t: self._settle(key, future, t))
+        return future
+
+    def _settle(self, key: str, future: asyncio.Future, task: asyncio.Task):
+        del self._flights[key]
+        if task.cancelled():
+            future.set_exception(FlightAbandoned())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+        future.exception()  # followers may all be gone; mark it retrieved
+
+    async def do(self, key: str, fn):
+        while True:
+            future = self._flights.get(key)
+            if future is None:
+                future = self.lead(key, fn)
+            else:
+                self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except FlightAbandoned:
+                continue
+
+    @asynccontextmanager
+    async def lock(self, key: str):
+        if not self.lock_dir:
+            yield
+            return
+        path = os.path.join(self.lock_dir, f"{int(key[:8], 16) % self.lock_stripes:04d}.lock")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    await asyncio.sleep(0.05)
+            if waited:
+                self.lock_waits += 1
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "shared_hits": self.shared_hits,
+            "saved_calls": self.coalesced + self.shared_hits,
+            "cross_process": bool(self.lock_dir),
+            "lock_waits": self.lock_waits,
+        }
+
+synthesis_flight = SingleFlight(SYNTHESIS_LOCK_DIR)
+
+# === MP3 splicing ===
+MPEG_VERSIONS = {3: 1, 2: 2, 0: 2.5}
+MPEG_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
+LAYER3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+def mp3_frame(data: bytes, offset: int):
+    """Parse the MPEG audio frame header at `offset`; return (length, format) or None."""
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    version = MPEG_VERSIONS.get((b1 >> 3) & 3)
+    layer = (b1 >> 1) & 3
+    bitrate_index, rate_index, padding = b2 >> 4, (b2 >> 2) & 3, (b2 >> 1) & 1
+    if version is None or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None  # only Layer III with a fixed bitrate, which is what ElevenLabs produces
+    bitrate = LAYER3_BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    length = (144 if version == 1 else 72) * bitrate // sample_rate + padding
+    mono = b3 >> 6 == 3
+    return length, (version, sample_rate, mono)
+
+def mp3_audio_frames(data: bytes):
+    """Return the audio frames of an MP3 without ID3 tags, the Xing/Info header frame or a torn tail."""
+    offset = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        offset = 10 + size + (10 if data[5] & 0x10 else 0)
+    while offset < len(data) and mp3_frame(data, offset) is None:
+        offset += 1
+    frames = []
+    fmt = None
+    while True:
+        frame = mp3_frame(data, offset)
+        if frame is None or offset + frame[0] > len(data):
+            break
+        length, frame_fmt = frame
+        if fmt is None:
+            fmt = frame_fmt
+            version, _, mono = fmt
+            side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+            tag = data[offset + 4 + side_info:offset + 8 + side_info]
+            if tag in (b"Xing", b"Info") or data[offset + 36:offset + 40] == b"VBRI":
+                offset += length
+                continue  # its frame count would be wrong for the spliced file
+        elif frame_fmt != fmt:
+            raise ValueError("MP3 changes format mid-stream")
+        frames.append(data[offset:offset + length])
+        offset += length
+    if not frames:
+        raise ValueError("no MPEG audio frames found")
+    return fmt, b"".join(frames)
+
+def splice_mp3(parts: list) -> bytes:
+    """Concatenate MP3 files at frame boundaries, without re-encoding."""
+    formats, bodies = zip(*(mp3_audio_frames(part) for part in parts))
+    if len(set(formats)) != 1:
+        raise ValueError(f"fragments have different formats: {set(formats)}")
+    return b"".join(bodies)
+
+# === ElevenLabs ===
+def normalize_name(name: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", name).split())
+
+# The invitation script; the fragments are joined with spaces for a full render.
+INVITATION_SEGMENTS = (
+    "Привет, {guest_name}!",
+    "Я Лис Рокки из Hello Park.",
+    "{birthday_kid}",
+    "приглашает тебя на свой день рождения, чтобы спасти космическую вечеринку! Я жду тебя, и у меня есть для тебя секретное задание!",
+)
+
+def invitation_text(guest_name: str, birthday_kid: str) -> str:
+    names = {"guest_name": normalize_name(guest_name), "birthday_kid": normalize_name(birthday_kid)}
+    return " ".join(segment.format(**names) for segment in INVITATION_SEGMENTS)
+
+def invitation_payloads(guest_name: str, birthday_kid: str) -> list:
+    """What to synthesize for one invitation: the whole script, or its fragments when SPLICED_AUDIO is on.
+
+    Fixed fragments have no names in them, so they are rendered once for every party. Name
+    fragments carry only fixed neighbours as context, so they are shared by every party with
+    that name.
+    """
+    if not SPLICED_AUDIO:
+        return [tts_payload(invitation_text(guest_name, birthday_kid))]
+    names = {"guest_name": normalize_name(guest_name), "birthday_kid": normalize_name(birthday_kid)}
+    payloads = []
+    for i, segment in enumerate(INVITATION_SEGMENTS):
+        if "{" not in segment:
+            payloads.append(tts_payload(segment))
+            continue
+        previous_text = INVITATION_SEGMENTS[i - 1] if i > 0 else None
+        next_text = INVITATION_SEGMENTS[i + 1] if i + 1 < len(INVITATION_SEGMENTS) else None
+        payloads.append(tts_payload(segment.format(**names), previous_text, next_text))
+    return payloads
+
+def tts_payload(text: str, previous_text: str = None, next_text: str = None) -> dict:
+    payload = {"text": text, "model_id": TTS_MODEL_ID, "voice_settings": TTS_VOICE_SETTINGS}
+    if previous_text:
+        payload["previous_text"] = previous_text
+    if next_text:
+        payload["next_text"] = next_text
+    return payload
+
+def audio_cache_key(payload: dict) -> str:
+    request = {"voice_id": VOICE_ID, **payload}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def fetch_tts(payload: dict) -> bytes:
+    response = await elevenlabs.post(
+        f"/v1/text-to-speech/{VOICE_ID}",
+        operation="tts",
+        headers={"Content-Type": "application/json", "xi-api-key": ELEVEN_LABS_API_KEY},
+        json=payload,
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="ElevenLabs API error")
+    return response.content
+
+async def recheck_shared_cache(key: str):
+    """Inside the cross-process lock: another worker may have produced the artifact meanwhile."""
+    if not synthesis_flight.lock_dir:
+        return None
+    audio = await get_cached_audio(key)
+    if audio is not None:
+        synthesis_flight.shared_hits += 1
+    return audio
+
+async def render_audio(payload: dict, key: str, spend_token: bool = True) -> bytes:
+    async with synthesis_flight.lock(key):
+        audio = await recheck_shared_cache(key)
+        if audio is not None:
+            return audio
+        # Interactive requests never wait for the bucket, but they do spend from it,
+        # so background rendering backs off while guests are tapping names.
+        if spend_token:
+            upstream_limiter(ELEVEN_LABS_API_KEY).consume()
+        audio = await fetch_tts(payload)
+        await asyncio.to_thread(audio_cache.put, key, audio)
+        return audio
+
+async def stream_audio(payload: dict, key: str, chunks: asyncio.Queue) -> bytes:
+    """Leader of a streamed render: push chunks to `chunks` as they arrive, then store the MP3.
+
+    Runs as its own task, so the artifact is finished and cached even if the client goes away.
+    The queue ends with an exception (on failure) and then `None`.
+    """
+    try:
+        async with synthesis_flight.lock(key):
+            audio = await recheck_shared_cache(key)
+            if audio is not None:
+                chunks.put_nowait(audio)
+                return audio
+            upstream_limiter(ELEVEN_LABS_API_KEY).consume()
+            parts = []
+            async with elevenlabs.stream(
+                "POST",
+                f"/v1/text-to-speech/{VOICE_ID}/stream",
+                operation="tts_stream",
+                headers={"Content-Type": "application/json", "xi-api-key": ELEVEN_LABS_API_KEY},
+                json=payload,
+            ) as response:
+                if response.status_code != 200:
+                    raise HTTPException(status_code=500, detail="ElevenLabs API error")
+                async for chunk in response.aiter_bytes():
+                    parts.append(chunk)
+                    chunks.put_nowait(chunk)
+            audio = b"".join(parts)
+            await asyncio.to_thread(audio_cache.put, key, audio)
+            return audio
+    except BaseException as e:
+        chunks.put_nowait(e)
+        raise
+    finally:
+        chunks.put_nowait(None)
+
+async def synthesize(payload: dict) -> bytes:
+    key = audio_cache_key(payload)
+    audio = await get_cached_audio(key)
+    if audio is not None:
+        return audio
+    return await synthesis_flight.do(key, lambda: render_audio(payload, key))
+
+async def synthesize_invitation(guest_name: str, birthday_kid: str) -> bytes:
+    payloads = invitation_payloads(guest_name, birthday_kid)
+    parts = await asyncio.gather(*(synthesize(payload) for payload in payloads))
+    if len(parts) == 1:
+        return parts[0]
+    try:
+        return splice_mp3(parts)
+    except ValueError as e:
+        logger.warning("Cannot splice invitation fragments (%s); rendering it whole", e)
+        return await synthesize(tts_payload(invitation_text(guest_name, birthday_kid)))
+
+async def synthesize_stream(text: str) -> Response:
+    """Relay the upstream streaming endpoint chunk by chunk, storing the full MP3 once it completes."""
+    payload = tts_payload(text)
+    key = audio_cache_key(payload)
+    audio = await get_cached_audio(key)
+    if audio is None and key in synthesis_flight:
+        audio = await synthesis_flight.do(key, lambda: render_audio(payload, key))
+    if audio is not None:
+        return Response(content=audio, media_type="audio/mpeg")
+    chunks = asyncio.Queue()
+    synthesis_flight.lead(key, lambda: stream_audio(payload, key, chunks))
+    # Wait for the first chunk so upstream errors still turn into a proper error status.
+    first = await chunks.get()
+    if isinstance(first, BaseException):
+        raise first
+
+    async def relay():
+        chunk = first
+        while chunk is not None:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+            chunk = await chunks.get()
+
+    return StreamingResponse(relay(), media_type="audio/mpeg")
+
+# === Rate limiting ===
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens: float = 1):
+        """Take tokens without waiting; the balance may go negative."""
+        self._refill()
+        self.tokens -= tokens
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:  # FIFO, so waiters are served in arrival order
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def penalize(self, seconds: float):
+        """Hold the bucket empty for `seconds`, e.g. to honour an upstream retry_after."""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+upstream_limiters = {}
+
+def upstream_limiter(api_key: str) -> TokenBucket:
+    """The key's bucket in this process, which gets an equal share of the key's rate."""
+    limiter = upstream_limiters.get(api_key)
+    if limiter is None:
+        limiter = upstream_limiters[api_key] = TokenBucket(ELEVEN_LABS_RATE / WORKERS,
+                                                           max(1.0, ELEVEN_LABS_BURST / WORKERS))
+    return limiter
+
+# === Background pre-rendering ===
+class Prerenderer:
+    """Worker pool that synthesizes every guest's invitation right after a party is created.
+
+    Progress lives in the `prerender_progress` table, which `_create_parties` fills in, so
+    every worker process can report it, whichever one does the rendering. The queue itself is
+    in memory, so the first process to start after a shutdown or crash calls `resume`.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = 0
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def schedule(self, party_id: str, birthday_kid: str, guests: list):
+        for guest in guests:
+            self.queue.put_nowait((party_id, guest, birthday_kid))
+
+    async def resume(self):
+        """Render again the parties a previous run left unfinished; audio it already made is skipped."""
+        parties = await db.write(_restart_prerenders)
+        for party in parties:
+            self.schedule(*party)
+        if parties:
+            logger.info("Resuming pre-render of %d parties", len(parties))
+
+    async def statuses(self, party_ids: list) -> dict:
+        """Progress for the parties that have any; older parties are not tracked."""
+        found = await db.run(_get_prerender_progress, list(dict.fromkeys(party_ids)))
+        statuses = {}
+        for party_id, progress in found.items():
+            pending = progress["total"] - progress["ready"] - progress["failed"]
+            statuses[party_id] = {**progress, "pending": pending, "done": pending == 0, "tracked": True}
+        return statuses
+
+    async def status(self, party_id: str):
+        return (await self.statuses([party_id])).get(party_id)
+
+    async def _worker(self):
+        while True:
+            party_id, guest, birthday_kid = await self.queue.get()
+            try:
+                try:
+                    for payload in invitation_payloads(guest, birthday_kid):
+                        await self._render(payload)
+                    outcome = "ready"
+                except Exception:
+                    logger.exception("Pre-render failed for party %s", party_id)
+                    self.failed += 1
+                    outcome = "failed"
+                await db.write(_count_prerender, party_id, outcome)
+            except sqlite3.Error as e:
+                logger.warning("Recording pre-render progress for party %s failed: %r", party_id, e)
+            finally:
+                self.queue.task_done()
+
+    async def _render(self, payload: dict):
+        key = audio_cache_key(payload)
+        if await get_cached_audio(key) is not None:
+            self.skipped += 1
+            return
+        if key not in synthesis_flight:
+            await upstream_limiter(ELEVEN_LABS_API_KEY).acquire()
+        await synthesis_flight.do(key, lambda: render_audio(payload, key, spend_token=False))
+        self.rendered += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "rendered": self.rendered,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+prerenderer = Prerenderer(PRERENDER_WORKERS)
 
 # === Telegram Bot (simple HTTP) ===
+class TelegramDispatcher:
+    """Outbound send queue drained by a few workers under a global token bucket and per-chat pacing.
+
+    Handlers only enqueue. Each chat has its own FIFO and a not-before time, and a chat is handed
+    to the workers only once its next message may go out, so a burst to one chat never parks the
+    pool. Workers honour `retry_after` on 429, back off on network and 5xx errors, and give up on
+    other 4xx. With `persist`, pending sends survive a restart and are replayed claim_batch at a time.
+
+    Persisted sends are leased to the process that queued them. With `shared` (several worker
+    processes on one database) each process also takes over sends whose lease has run out.
+    """
+
+    max_paced_chats = 10000
+    claim_batch = 100
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, max_attempts: int, persist: bool,
+                 shared: bool = False, lease_seconds: float = 60.0, poll_interval: float = 5.0):
+        self.workers = workers
+        self.chat_interval = 1 / chat_rate
+        self.max_attempts = max_attempts
+        self.persist = persist
+        self.shared = shared
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.ready = asyncio.Queue()  # chat IDs whose next message may be sent now
+        self.chats = {}  # chat_id -> deque of messages; present while the chat has work or a send in flight
+        self.not_before = OrderedDict()  # chat_id -> monotonic time its next send may start
+        self.held = set()  # outbox IDs queued or being sent by this process
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.queued = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.sending = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.reclaimed = 0
+        self.leases_lost = 0
+        self._tasks = []
+
+    async def start(self):
+        if self.persist and not self.shared:
+            # A lone process owns every row, including the ones leased by its previous run.
+            await db.write(_outbox_release)
+        if self.persist:
+            await self._claim(time.time())
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.persist:
+            # Claims are capped at claim_batch, so the rest of a backlog is picked up here too.
+            self._tasks.append(asyncio.create_task(self._reclaim()))
+
+    async def _claim(self, expired_before: float):
+        limit = self.claim_batch - self.queued
+        if limit <= 0:
+            return
+        rows = await db.write(_outbox_claim, WORKER_ID, expired_before, time.time() + self.lease_seconds, limit)
+        for outbox_id, chat_id, payload in rows:
+            if outbox_id not in self.held:  # our own lease lapsed while queued; it is renewed on send
+                self._enqueue(chat_id, json.loads(payload), outbox_id)
+                self.reclaimed += 1
+
+    async def _reclaim(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._claim(time.time())
+            except sqlite3.Error as e:
+                logger.warning("Claiming expired Telegram sends failed: %r", e)
+
+    async def _hold(self, message: dict) -> bool:
+        """Make sure our lease on a persisted send outlasts the next attempt."""
+        if message["outbox_id"] is None or message["lease_until"] - time.time() > self.lease_seconds / 2:
+            return True
+        lease_until = time.time() + self.lease_seconds
+        if not await db.write(_outbox_renew, message["outbox_id"], WORKER_ID, lease_until):
+            self.leases_lost += 1
+            return False
+        message["lease_until"] = lease_until
+        return True
+
+    async def stop(self, drain_timeout: float = 5.0):
+        try:
+            await asyncio.wait_for(self._drained.wait(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with %d Telegram messages still queued", self.queued)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def send(self, chat_id: int, payload: dict):
+        outbox_id = None
+        if self.persist:
+            outbox_id = await db.write(_outbox_add, chat_id, json.dumps(payload, ensure_ascii=False),
+                                       WORKER_ID, time.time() + self.lease_seconds)
+        self._enqueue(chat_id, payload, outbox_id)
+
+    def _enqueue(self, chat_id: int, payload: dict, outbox_id):
+        if outbox_id is not None:
+            self.held.add(outbox_id)
+        self.queued += 1
+        self._drained.clear()
+        message = {"chat_id": chat_id, "payload": payload, "outbox_id": outbox_id, "attempts": 0,
+                   "lease_until": time.time() + self.lease_seconds, "enqueued_at": time.monotonic()}
+        messages = self.chats.get(chat_id)
+        if messages is None:
+            self.chats[chat_id] = deque([message])
+            self._schedule(chat_id)
+        else:
+            messages.append(message)  # picked up when the chat's current send finishes
+
+    def _schedule(self, chat_id: int):
+        delay = self.not_before.get(chat_id, 0.0) - time.monotonic()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, chat_id)
+        else:
+            self.ready.put_nowait(chat_id)
+
+    def _pace(self, chat_id: int, delay: float):
+        """Keep the chat's next send at least `delay` seconds away."""
+        self.not_before[chat_id] = max(self.not_before.get(chat_id, 0.0), time.monotonic() + delay)
+        self.not_before.move_to_end(chat_id)
+        while len(self.not_before) > self.max_paced_chats:
+            self.not_before.popitem(last=False)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            messages = self.chats[chat_id]
+            message = messages.popleft()
+            self.sending += 1
+            finished = True
+            try:
+                finished = await self._attempt(message)
+            except Exception:
+                logger.exception("Telegram send to chat %s crashed", chat_id)
+                self.failed += 1
+            finally:
+                self.sending -= 1
+                if finished:
+                    self.held.discard(message["outbox_id"])
+                    self.queued -= 1
+                    if not self.queued:
+                        self._drained.set()
+                else:
+                    messages.appendleft(message)  # retries keep their place in the chat's order
+                if messages:
+                    self._schedule(chat_id)
+                else:
+                    del self.chats[chat_id]
+
+    async def _attempt(self, message: dict) -> bool:
+        """Make one delivery attempt. Returns False if the message should be retried later."""
+        chat_id = message["chat_id"]
+        self._pace(chat_id, self.chat_interval)
+        await self.global_bucket.acquire()
+        if not await self._hold(message):
+            return True  # another worker took it over and sends it
+        message["attempts"] += 1
+        try:
+            response = await telegram.post(f"/bot{BOT_TOKEN}/sendMessage", operation="sendMessage",
+                                          json=message["payload"])
+        except httpx.HTTPError as e:
+            logger.warning("Telegram send to chat %s failed: %r", chat_id, e)
+            status = None
+        else:
+            status = response.status_code
+        if status == 200:
+            self.sent += 1
+            latency = time.monotonic() - message["enqueued_at"]
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+        elif status is not None and status != 429 and status < 500:
+            logger.warning("Telegram rejected message to chat %s: %s %s", chat_id, status, response.text)
+            self.failed += 1
+        elif message["attempts"] < self.max_attempts:
+            self.retries += 1
+            if status == 429:
+                self.rate_limited += 1
+                try:
+                    retry_after = response.json()["parameters"]["retry_after"]
+                except (ValueError, KeyError, TypeError):
+                    retry_after = 1
+                # Flood limits are mostly per bot, so hold every chat back, not just this one.
+                self.global_bucket.penalize(retry_after)
+                self._pace(chat_id, retry_after)
+            else:
+                self._pace(chat_id, min(30.0, 0.5 * 2 ** message["attempts"]) * random.uniform(0.5, 1.0))
+            return False
+        else:
+            if status == 429:
+                self.rate_limited += 1
+            logger.error("Giving up on message to chat %s after %d attempts", chat_id, self.max_attempts)
+            self.failed += 1
+        if message["outbox_id"] is not None:
+            await db.write(_outbox_delete, message["outbox_id"])
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued - self.sending,
+            "chats": len(self.chats),
+            "sending": self.sending,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "latency_seconds_avg": round(self.latency_total / self.sent, 6) if self.sent else 0.0,
+            "latency_seconds_max": round(self.latency_max, 6),
+            "persistent": self.persist,
+            "held": len(self.held),
+            "reclaimed": self.reclaimed,
+            "leases_lost": self.leases_lost,
+        }
+
+# Every worker process sends, so each gets its share of Telegram's limits.
+dispatcher = TelegramDispatcher(TELEGRAM_SEND_WORKERS, TELEGRAM_GLOBAL_RATE / WORKERS, TELEGRAM_CHAT_RATE / WORKERS,
+                                TELEGRAM_SEND_ATTEMPTS, TELEGRAM_OUTBOX, WORKERS > 1, OUTBOX_LEASE_SECONDS,
+                                OUTBOX_POLL_INTERVAL)
+
 async def send_telegram_message(chat_id: int, text: str, reply_markup: dict = None):
+    """Queue a message for delivery; returns without waiting for Telegram."""
     if not BOT_TOKEN:
         return
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
     if reply_markup:
         payload["reply_markup"] = reply_markup
-    async with httpx.AsyncClient() as client:
-        await client.post(url, json=payload)
+    await dispatcher.send(chat_id, payload)
 
 async def handle_telegram_update(update: dict):
     message = update.get("message")
@@ -84,7 +1676,7 @@ async def handle_telegram_update(update: dict):
         if len(parts) > 1:
             # Гость переходит по ссылке
             party_id = parts[1]
-            party = get_party(party_id)
+            party = await get_party(party_id)
             if party:
                 webapp_url = f"{APP_URL}?party={party_id}"
                 reply_markup = {
@@ -119,25 +1711,281 @@ async def handle_telegram_update(update: dict):
                 reply_markup
             )
 
+# === Update ingestion ===
+def update_chat_id(update: dict):
+    for field in ("message", "edited_message", "callback_query"):
+        body = update.get(field)
+        if isinstance(body, dict):
+            chat = body.get("chat") or (body.get("message") or {}).get("chat") or body.get("from") or {}
+            if "id" in chat:
+                return chat["id"]
+    return None
+
+class UpdatePipeline:
+    """Bounded queues of Telegram updates drained by async workers.
+
+    Updates are deduplicated on `update_id` and sharded by chat, so one chat's updates are
+    always handled by the same worker, in the order they arrived. With `dedup_ttl` set, the
+    dedup also goes through the `seen_updates` table, since a redelivery may reach another process.
+    """
+
+    def __init__(self, workers: int, queue_size: int, dedup_size: int, dedup_ttl: float = 0):
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.dedup_size = dedup_size
+        self.dedup_ttl = dedup_ttl
+        self.seen = OrderedDict()  # update_id -> None
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    async def stop(self, drain_timeout: float = 5.0):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with %d Telegram updates unprocessed", sum(q.qsize() for q in self.queues))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, update: dict, timeout: float = None) -> bool:
+        """Queue an update. Returns False when the queue stayed full for `timeout` seconds."""
+        update_id = update["update_id"]
+        self.received += 1
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+        self.seen[update_id] = None
+        while len(self.seen) > self.dedup_size:
+            self.seen.popitem(last=False)
+        if self.dedup_ttl:
+            try:
+                first = await db.write(_mark_update_seen, update_id, time.time() - self.dedup_ttl)
+            except sqlite3.Error:
+                self.seen.pop(update_id, None)  # the caller fails, so Telegram will deliver it again
+                raise
+            if not first:
+                self.duplicates += 1
+                return True
+        chat_id = update_chat_id(update)
+        shard = self.queues[hash(chat_id if chat_id is not None else update_id) % len(self.queues)]
+        try:
+            shard.put_nowait(update)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(shard.put(update), timeout)
+            except asyncio.TimeoutError:
+                # Forget it so Telegram's redelivery is not mistaken for a duplicate.
+                self.seen.pop(update_id, None)
+                if self.dedup_ttl:
+                    await db.write(_forget_update, update_id)
+                self.rejected += 1
+                return False
+        return True
+
+    async def _worker(self, updates: asyncio.Queue):
+        while True:
+            update = await updates.get()
+            try:
+                await handle_telegram_update(update)
+                self.processed += 1
+            except Exception:
+                logger.exception("Failed to handle update %s", update.get("update_id"))
+                self.failed += 1
+            finally:
+                updates.task_done()
+
+    def stats(self) -> dict:
+        depths = [q.qsize() for q in self.queues]
+        return {
+            "queued": sum(depths),
+            "max_shard_depth": max(depths),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+update_pipeline = UpdatePipeline(UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_DEDUP_SIZE,
+                                 UPDATE_DEDUP_TTL if WORKERS > 1 else 0)
+
+async def poll_updates():
+    """Long-poll getUpdates and feed the same pipeline as the webhook (needs no webhook set)."""
+    offset = None
+    while True:
+        try:
+            response = await telegram.post(
+                f"/bot{BOT_TOKEN}/getUpdates",
+                operation="getUpdates",
+                json={"offset": offset, "timeout": TELEGRAM_POLL_TIMEOUT},
+                timeout=TELEGRAM_POLL_TIMEOUT + TELEGRAM_TIMEOUT,
+            )
+            if response.status_code != 200:
+                logger.warning("getUpdates failed: %s %s", response.status_code, response.text)
+                await asyncio.sleep(5)
+                continue
+            for update in response.json().get("result", []):
+                offset = update["update_id"] + 1  # first, so a bad update is not fetched again
+                await update_pipeline.submit(update)
+        except httpx.HTTPError as e:
+            logger.warning("getUpdates failed: %r", e)
+            await asyncio.sleep(1)
+        except Exception:
+            # A garbled body or update must not end the task: polling would stop without a trace.
+            logger.exception("getUpdates returned something unusable")
+            await asyncio.sleep(1)
+
+async def lead_polling():
+    """Run `poll_updates` in whichever worker process holds the poller lock; the others stand by."""
+    fd = os.open(f"{DB_PATH}.poller.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(5)
+        logger.info("Worker %s is polling for Telegram updates", WORKER_ID)
+        await poll_updates()
+    finally:
+        os.close(fd)
+
+# === Static assets ===
+def accepted_encodings(header: str) -> dict:
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        coding = coding.strip().lower()
+        if coding:
+            accepted[coding] = q
+    return accepted
+
+class StaticAsset:
+    """A page or file compressed once at startup and served with strong ETags."""
+
+    def __init__(self, body: bytes, media_type: str):
+        self.media_type = media_type
+        digest = hashlib.sha256(body).hexdigest()
+        self.fingerprint = digest[:12]
+        self.variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body, quality=11)
+        # Each encoding is a different representation, so it gets its own strong validator.
+        self.etags = {coding: f'"{digest[:32]}-{coding}"' for coding in self.variants}
+
+    def pick_encoding(self, accept_encoding: str) -> str:
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ("br", "gzip"):
+            if coding in self.variants and accepted.get(coding, accepted.get("*", 0)) > 0:
+                if len(self.variants[coding]) < len(self.variants["identity"]):
+                    return coding
+        return "identity"
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        coding = self.pick_encoding(request.headers.get("accept-encoding", ""))
+        headers = {"ETag": self.etags[coding], "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            # Only the selected representation's validator counts; a 304 stands for that one.
+            if "*" in tags or self.etags[coding] in tags:
+                return Response(status_code=304, headers=headers)
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return Response(content=self.variants[coding], media_type=self.media_type, headers=headers)
+
+static_assets = {}
+
+def build_static_assets():
+    style = StaticAsset(STYLE_CONTENT.encode(), "text/css; charset=utf-8")
+    script = StaticAsset(SCRIPT_CONTENT.encode(), "application/javascript; charset=utf-8")
+    static_assets.clear()
+    static_assets[f"app.{style.fingerprint}.css"] = style
+    static_assets[f"app.{script.fingerprint}.js"] = script
+    html = (HTML_TEMPLATE
+            .replace("__STYLE_URL__", f"/assets/app.{style.fingerprint}.css")
+            .replace("__SCRIPT_URL__", f"/assets/app.{script.fingerprint}.js"))
+    static_assets["index.html"] = StaticAsset(html.encode(), "text/html; charset=utf-8")
+
 # === FastAPI ===
+def collect_stats() -> dict:
+    return {
+        "audio_cache": audio_cache.stats(),
+        "prerender": prerenderer.stats(),
+        "synthesis": synthesis_flight.stats(),
+        "telegram_outbox": dispatcher.stats(),
+        "updates": update_pipeline.stats(),
+        "http": {"elevenlabs": elevenlabs.stats(), "telegram": telegram.stats()},
+        "db": db.stats(),
+        "party_cache": party_cache.stats(),
+        "process": {"workers": WORKERS, "pid": os.getpid()},
+    }
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    process_lock, alone = lock_processes()
     init_db()
+    db.open()
+    build_static_assets()
+    if profiler is not None:
+        profiler.start()
+    await asyncio.to_thread(audio_cache.load)
+    if SYNTHESIS_LOCK_DIR:
+        os.makedirs(SYNTHESIS_LOCK_DIR, exist_ok=True)
+    elevenlabs.open()
+    telegram.open()
+    await party_cache.start()
+    await dispatcher.start()
+    prerenderer.start()
+    if alone:
+        await prerenderer.resume()
+    update_pipeline.start()
+    poller = asyncio.create_task(lead_polling()) if TELEGRAM_POLLING and BOT_TOKEN else None
     yield
+    if poller is not None:
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+    await update_pipeline.stop()
+    await prerenderer.stop()
+    await dispatcher.stop()
+    await party_cache.stop()
+    await elevenlabs.close()
+    await telegram.close()
+    db.close()
+    os.close(process_lock)
 
 app = FastAPI(lifespan=lifespan)
 
+app.add_middleware(MetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Claim-Status"],
 )
 
 # === API Models ===
 class GenerateRequest(BaseModel):
     guest_name: str
     birthday_kid: str
+    stream: bool = False
 
 class CreatePartyRequest(BaseModel):
     birthday_kid: str
@@ -149,52 +1997,340 @@ class ClaimGuestRequest(BaseModel):
     guest_name: str
     tg_id: int
 
+class ClaimAndRenderRequest(BaseModel):
+    party_id: str
+    guest_name: str
+    tg_id: int = 0
+    stream: bool = False
+
+class BatchCreatePartiesRequest(BaseModel):
+    parties: list[CreatePartyRequest]
+
+class BatchClaimRequest(BaseModel):
+    claims: list[ClaimGuestRequest]
+
+class BatchStatusRequest(BaseModel):
+    party_ids: list[str]
+
 # === API Endpoints ===
+async def invitation_response(guest_name: str, birthday_kid: str, stream: bool) -> Response:
+    if stream and not SPLICED_AUDIO:
+        return await synthesize_stream(invitation_text(guest_name, birthday_kid))
+    audio = await synthesize_invitation(guest_name, birthday_kid)
+    return Response(content=audio, media_type="audio/mpeg")
+
 @app.post("/api/generate-audio")
 async def generate_audio(req: GenerateRequest):
-    text = f"Привет, {req.guest_name}! Я Лис Рокки из Hello Park. {req.birthday_kid} приглашает тебя на свой день рождения, чтобы спасти космическую вечеринку! Я жду тебя, и у меня есть для тебя секретное задание!"
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}",
-            headers={"Content-Type": "application/json", "xi-api-key": ELEVEN_LABS_API_KEY},
-            json={"text": text, "model_id": "eleven_multilingual_v2",
-                  "voice_settings": {"stability": 0.5, "similarity_boost": 0.75}},
-            timeout=30.0
-        )
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="ElevenLabs API error")
-        return Response(content=response.content, media_type="audio/mpeg")
+    return await invitation_response(req.guest_name, req.birthday_kid, req.stream)
+
+def new_party_id() -> str:
+    return str(uuid.uuid4())[:8]
+
+def share_link(party_id: str) -> str:
+    return f"https://t.me/{BOT_USERNAME}?start={party_id}"
+
+def check_batch_size(items: list):
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+
+def party_problem(party: CreatePartyRequest):
+    """Why a party from a bulk request cannot be created, or None."""
+    if not party.birthday_kid.strip() or not any(guest.strip() for guest in party.guests):
+        return "birthday_kid and at least one guest are required"
+    return None
 
 @app.post("/api/party")
 async def create_party_endpoint(req: CreatePartyRequest):
-    party_id = str(uuid.uuid4())[:8]
-    create_party(party_id, req.birthday_kid, req.guests, req.tg_id)
-    bot_username = "RockyHelloParkBot"
-    return {"party_id": party_id, "share_link": f"https://t.me/{bot_username}?start={party_id}"}
+    party_id = new_party_id()
+    await create_party(party_id, req.birthday_kid, req.guests, req.tg_id)
+    prerenderer.schedule(party_id, req.birthday_kid, req.guests)
+    return {"party_id": party_id, "share_link": share_link(party_id)}
+
+@app.post("/api/parties/batch")
+async def create_parties_endpoint(req: BatchCreatePartiesRequest):
+    """Create all valid parties in one transaction; invalid ones get an error result."""
+    check_batch_size(req.parties)
+    results, rows = [], []
+    for i, p in enumerate(req.parties):
+        problem = party_problem(p)
+        if problem:
+            results.append({"index": i, "status": "error", "error": problem})
+            continue
+        party_id = new_party_id()
+        rows.append((party_id, p.birthday_kid, p.guests, p.tg_id))
+        results.append({"index": i, "status": "created", "party_id": party_id, "share_link": share_link(party_id)})
+    if rows:
+        await create_parties(rows)
+    for party_id, birthday_kid, guests, _ in rows:
+        prerenderer.schedule(party_id, birthday_kid, guests)
+    return {"results": results}
+
+async def aenumerate(iterable, start: int = 1):
+    i = start
+    async for item in iterable:
+        yield i, item
+        i += 1
+
+async def request_lines(request: Request):
+    """Yield the body's lines; one longer than IMPORT_MAX_LINE is yielded as None and its text dropped."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+    skipping = False  # inside a too-long line that was already reported
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if skipping:
+                skipping = False
+                continue
+            yield line.rstrip("\r") if len(line) <= IMPORT_MAX_LINE else None
+        if len(buffer) > IMPORT_MAX_LINE:
+            if not skipping:
+                yield None
+                skipping = True
+            buffer = ""
+    buffer += decoder.decode(b"", final=True)
+    if buffer and not skipping:
+        yield buffer.rstrip("\r") if len(buffer) <= IMPORT_MAX_LINE else None
+
+def csv_quote_open(line: str, quoted: bool = False) -> bool:
+    """Whether a quoted CSV field is still open after `line`, following the default csv dialect.
+
+    A `"` only opens a field when it is the field's first character; inside a quoted field
+    `""` is a literal quote and a lone `"` closes it.
+    """
+    at_start = not quoted
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if quoted:
+            if c == '"':
+                if line[i + 1:i + 2] == '"':
+                    i += 1
+                else:
+                    quoted = False
+        elif c == ",":
+            at_start = True
+            i += 1
+            continue
+        elif c == '"' and at_start:
+            quoted = True
+        at_start = False
+        i += 1
+    return quoted
+
+async def parse_import(request: Request):
+    """Yield `(line_number, CreatePartyRequest or error message)` from a CSV or NDJSON body.
+
+    CSV needs a header with `birthday_kid` and `guests` (names separated by `;` or line breaks
+    inside a quoted cell); `tg_id` is optional. NDJSON lines are objects shaped like
+    `POST /api/party` bodies. Lines over IMPORT_MAX_LINE are reported and skipped.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "csv" in content_type:
+        header = None
+        record = deque()  # physical lines of the current record, fed to `reader` on demand
+        reader = csv.reader(iter(record.popleft, None))
+        quoted = False
+        size = record_start = 0
+        async for line_no, line in aenumerate(request_lines(request)):
+            if line is None:
+                record.clear()
+                quoted, size = False, 0
+                yield line_no, "Line too long"
+                continue
+            if not record and not line.strip():
+                continue
+            if not record:
+                record_start = line_no
+            record.append(line + "\n")
+            quoted = csv_quote_open(line, quoted)
+            size += len(line)
+            if quoted and size <= IMPORT_MAX_LINE:
+                continue  # a quoted field runs on to the next line
+            if quoted:
+                record.clear()
+                quoted, size = False, 0
+                yield record_start, "Record too long (unclosed quote?)"
+                continue
+            size = 0
+            line_no = record_start
+            try:
+                row = next(reader)
+            except (IndexError, csv.Error) as e:
+                # the reader wanted more (or other) lines than the record held; start it afresh
+                record.clear()
+                reader = csv.reader(iter(record.popleft, None))
+                yield line_no, f"Malformed CSV record: {e}"
+                continue
+            if header is None:
+                header = [name.strip().lower() for name in row]
+                if not {"birthday_kid", "guests"} <= set(header):
+                    raise HTTPException(status_code=400, detail="CSV header needs birthday_kid and guests")
+                continue
+            fields = dict(zip(header, row))
+            try:
+                yield line_no, CreatePartyRequest(
+                    birthday_kid=fields.get("birthday_kid", "").strip(),
+                    guests=[g.strip() for g in fields.get("guests", "").replace("\n", ";").split(";") if g.strip()],
+                    tg_id=int(fields.get("tg_id") or 0),
+                )
+            except (ValueError, ValidationError) as e:
+                yield line_no, str(e)
+        if record:
+            yield record_start, "Unclosed quote at end of file"
+    elif "ndjson" in content_type or "jsonl" in content_type:
+        async for line_no, line in aenumerate(request_lines(request)):
+            if line is None:
+                yield line_no, "Line too long"
+                continue
+            if not line.strip():
+                continue
+            try:
+                yield line_no, CreatePartyRequest(**json.loads(line))
+            except (ValueError, TypeError, ValidationError) as e:
+                yield line_no, str(e)
+    else:
+        raise HTTPException(status_code=415, detail="Send text/csv or application/x-ndjson")
+
+@app.post("/api/parties/import")
+async def import_parties_endpoint(request: Request):
+    """Streamed bulk import; every IMPORT_BATCH_SIZE parties are committed together."""
+    results = []
+    pending = []
+
+    async def flush():
+        rows = [(party_id, p.birthday_kid, p.guests, p.tg_id) for _, party_id, p in pending]
+        try:
+            await create_parties(rows)
+        except sqlite3.Error as e:
+            logger.exception("Import batch failed")
+            results.extend({"line": line_no, "status": "error", "error": str(e)} for line_no, _, _ in pending)
+        else:
+            for line_no, party_id, p in pending:
+                prerenderer.schedule(party_id, p.birthday_kid, p.guests)
+                results.append({"line": line_no, "status": "created", "party_id": party_id,
+                                "share_link": share_link(party_id)})
+        pending.clear()
+
+    async for line_no, item in parse_import(request):
+        if not isinstance(item, str):
+            item = party_problem(item) or item
+        if isinstance(item, str):
+            results.append({"line": line_no, "status": "error", "error": item})
+            continue
+        pending.append((line_no, new_party_id(), item))
+        if len(pending) >= IMPORT_BATCH_SIZE:
+            await flush()
+    if pending:
+        await flush()
+    results.sort(key=lambda r: r["line"])
+    created = sum(1 for r in results if r["status"] == "created")
+    return {"created": created, "failed": len(results) - created, "results": results}
+
+@app.post("/api/parties/status")
+async def parties_status_endpoint(req: BatchStatusRequest):
+    check_batch_size(req.party_ids)
+    parties = await get_parties(req.party_ids)
+    audio = await prerenderer.statuses(req.party_ids)
+    return {"results": [
+        {"party_id": party_id, "status": "found" if parties[party_id] else "not_found",
+         "party": parties[party_id], "audio": audio.get(party_id)}
+        for party_id in req.party_ids
+    ]}
 
 @app.get("/api/party/{party_id}")
 async def get_party_endpoint(party_id: str):
-    party = get_party(party_id)
+    party = await get_party(party_id)
     if not party:
         raise HTTPException(status_code=404, detail="Party not found")
     return party
 
+@app.get("/api/party/{party_id}/audio-status")
+async def party_audio_status_endpoint(party_id: str):
+    status = await prerenderer.status(party_id)
+    if status is not None:
+        return status
+    party = await get_party(party_id)
+    if not party:
+        raise HTTPException(status_code=404, detail="Party not found")
+    # A real party created before progress was tracked.
+    return {"total": len(party["guests"]), "ready": None, "failed": None, "pending": None, "done": None,
+            "tracked": False}
+
 @app.post("/api/claim")
 async def claim_guest_endpoint(req: ClaimGuestRequest):
-    claim_guest(req.party_id, req.guest_name, req.tg_id)
-    return {"status": "ok"}
+    result = await claim_guest(req.party_id, req.guest_name, req.tg_id)
+    return {"status": "ok", "claim": result}
+
+@app.post("/api/claim/batch")
+async def claim_guests_endpoint(req: BatchClaimRequest):
+    """Apply all claims in one transaction."""
+    check_batch_size(req.claims)
+    results = await claim_guests([(c.party_id, c.guest_name, c.tg_id) for c in req.claims])
+    return {"results": [{"index": i, "party_id": c.party_id, "guest_name": c.guest_name, "claim": result}
+                        for i, (c, result) in enumerate(zip(req.claims, results))]}
+
+@app.post("/api/claim-and-render")
+async def claim_and_render_endpoint(req: ClaimAndRenderRequest):
+    """Claim the name (unless tg_id is 0, e.g. the organizer's preview) and answer with the audio.
+
+    The claim outcome is in the X-Claim-Status header; a name taken by someone else is a 409.
+    """
+    if req.tg_id:
+        result, party = await asyncio.gather(claim_guest(req.party_id, req.guest_name, req.tg_id),
+                                             get_party(req.party_id))
+    else:
+        result, party = "preview", await get_party(req.party_id)
+    if not party or result == "not_found":
+        raise HTTPException(status_code=404, detail="Guest not found")
+    if result == "taken":
+        return JSONResponse({"detail": "Guest already claimed", "claim": result},
+                            status_code=409, headers={"X-Claim-Status": result})
+    response = await invitation_response(req.guest_name, party["birthday_kid"], req.stream)
+    response.headers["X-Claim-Status"] = result
+    return response
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
-    data = await request.json()
-    await handle_telegram_update(data)
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        raise HTTPException(status_code=400, detail="Invalid update")
+    if not await update_pipeline.submit(data, timeout=UPDATE_ENQUEUE_TIMEOUT):
+        raise HTTPException(status_code=503, detail="Too many pending updates")
     return {"status": "ok"}
 
+@app.get("/api/stats")
+async def stats_endpoint():
+    return collect_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    lines = []
+    for metric in (http_request_seconds, http_responses_total, upstream_request_seconds,
+                   upstream_responses_total, db_call_seconds, slow_requests_total):
+        lines += metric.render()
+    lines += render_stats_gauges(collect_stats())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 @app.get("/", response_class=HTMLResponse)
-async def index():
-    return HTML_CONTENT
+async def index(request: Request):
+    return static_assets["index.html"].response(request, "no-cache")
 
-HTML_CONTENT = '''
+@app.get("/assets/{name}")
+async def asset(name: str, request: Request):
+    asset = static_assets.get(name)
+    if asset is None or name == "index.html":
+        raise HTTPException(status_code=404, detail="Not found")
+    return asset.response(request, "public, max-age=31536000, immutable")
+
+HTML_TEMPLATE = '''
 <!DOCTYPE html>
 <html lang="ru">
 <head>
@@ -202,49 +2338,7 @@ HTML_CONTENT = '''
     <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
     <title>Приглашение от Рокки</title>
     <script src="https://telegram.org/js/telegram-web-app.js"></script>
-    <style>
-        * { box-sizing: border-box; margin: 0; padding: 0; }
-        body { font-family: system-ui, sans-serif; min-height: 100vh;
-            background: linear-gradient(135deg, #1a1a2e 0%, #16213e 100%); padding: 20px; }
-        .container { max-width: 400px; margin: 0 auto; }
-        .card { background: rgba(255,255,255,0.1); border-radius: 20px; padding: 24px;
-            backdrop-filter: blur(10px); margin-bottom: 16px; }
-        .header { text-align: center; margin-bottom: 24px; }
-        .emoji { font-size: 48px; margin-bottom: 8px; }
-        .emoji-large { font-size: 64px; margin-bottom: 16px; }
-        h1 { color: #fff; font-size: 22px; }
-        h2 { color: #fff; font-size: 18px; margin-bottom: 16px; }
-        p { color: rgba(255,255,255,0.7); font-size: 14px; margin-top: 8px; line-height: 1.5; }
-        label { color: rgba(255,255,255,0.9); font-size: 14px; display: block; margin-bottom: 8px; }
-        input { width: 100%; padding: 12px 16px; border-radius: 12px; border: none;
-            font-size: 16px; background: rgba(255,255,255,0.9); }
-        .input-row { display: flex; gap: 8px; }
-        .input-row input { flex: 1; }
-        .btn { padding: 16px; border-radius: 12px; border: none; font-size: 16px;
-            cursor: pointer; width: 100%; font-weight: 600; }
-        .btn-primary { background: linear-gradient(135deg, #ff6b35 0%, #f7931e 100%); color: #fff; }
-        .btn-add { padding: 12px 20px; width: auto; background: #ff6b35; color: #fff; }
-        .btn-secondary { background: rgba(255,107,53,0.1); border: 2px solid rgba(255,107,53,0.5); color: #fff; }
-        .btn-play { padding: 16px 32px; border-radius: 50px; width: auto;
-            margin: 20px auto 0; display: flex; align-items: center; gap: 8px; font-size: 18px; }
-        .btn-back { background: transparent; color: rgba(255,255,255,0.5); font-size: 14px; padding: 12px; }
-        .btn:disabled { background: rgba(255,255,255,0.2); cursor: not-allowed; }
-        .guests { margin: 20px 0; }
-        .guests-label { color: rgba(255,255,255,0.7); font-size: 13px; margin-bottom: 8px; }
-        .guest-tags { display: flex; flex-wrap: wrap; gap: 8px; }
-        .guest-tag { background: rgba(255,107,53,0.3); color: #fff; padding: 8px 12px;
-            border-radius: 20px; font-size: 14px; display: flex; align-items: center; gap: 8px; }
-        .guest-tag span { cursor: pointer; opacity: 0.7; }
-        .guest-btn { padding: 16px 20px; margin-bottom: 12px; font-size: 18px; }
-        .field { margin-bottom: 20px; }
-        .task-placeholder { background: linear-gradient(135deg, #2a2a4a 0%, #1a1a3a 100%);
-            border-radius: 12px; padding: 40px 20px; text-align: center; margin-bottom: 16px; }
-        .loading { opacity: 0.7; pointer-events: none; }
-        .hidden { display: none; }
-        .share-link { background: rgba(255,255,255,0.1); border-radius: 12px; padding: 16px;
-            word-break: break-all; color: #fff; font-size: 14px; margin: 16px 0; }
-        .btn-copy { background: #4CAF50; margin-top: 8px; }
-    </style>
+    <link rel="stylesheet" href="__STYLE_URL__">
 </head>
 <body>
     <div class="container">
@@ -318,94 +2412,161 @@ HTML_CONTENT = '''
             </div>
         </div>
     </div>
-    <script>
-        const tg = window.Telegram?.WebApp;
-        if (tg) tg.expand();
-        const urlParams = new URLSearchParams(window.location.search);
-        const partyId = urlParams.get('party');
-        const tgId = urlParams.get('tg_id') || tg?.initDataUnsafe?.user?.id || 0;
-        let guests = [], birthdayKid = '', currentPartyId = partyId, shareLink = '';
-        if (partyId) loadParty(partyId);
-        async function loadParty(id) {
-            try {
-                const r = await fetch(`/api/party/${id}`);
-                if (r.ok) {
-                    const d = await r.json();
-                    birthdayKid = d.birthday_kid;
-                    guests = d.guests.map(g => g.name);
-                    document.getElementById('select-title').textContent = `${birthdayKid} приглашает тебя на День Рождения!`;
-                    renderGuestButtons();
-                    showScreen('select');
-                }
-            } catch (e) { console.error(e); }
-        }
-        function renderGuestButtons() {
-            document.getElementById('guest-buttons').innerHTML = guests.map(g =>
-                `<button class="btn btn-secondary guest-btn" onclick="selectGuest('${g}')">${g}</button>`).join('');
-        }
-        document.getElementById('new-guest')?.addEventListener('keypress', e => { if (e.key === 'Enter') addGuest(); });
-        function addGuest() {
-            const i = document.getElementById('new-guest'), n = i.value.trim();
-            if (n && !guests.includes(n)) { guests.push(n); i.value = ''; renderGuests(); }
-        }
-        function removeGuest(n) { guests = guests.filter(g => g !== n); renderGuests(); }
-        function renderGuests() {
-            const c = document.getElementById('guests-container'), l = document.getElementById('guests-list'),
-                  cnt = document.getElementById('guests-count'), btn = document.getElementById('create-btn'),
-                  kid = document.getElementById('birthday-kid').value.trim();
-            if (guests.length > 0) {
-                c.classList.remove('hidden'); cnt.textContent = guests.length;
-                l.innerHTML = guests.map(g => `<div class="guest-tag">${g}<span onclick="removeGuest('${g}')">✕</span></div>`).join('');
-            } else c.classList.add('hidden');
-            btn.disabled = !(guests.length > 0 && kid);
-        }
-        document.getElementById('birthday-kid')?.addEventListener('input', renderGuests);
-        async function createParty() {
-            birthdayKid = document.getElementById('birthday-kid').value.trim();
-            const btn = document.getElementById('create-btn');
-            btn.textContent = '⏳ Создаём...'; btn.disabled = true;
-            try {
-                const r = await fetch('/api/party', { method: 'POST', headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({ birthday_kid: birthdayKid, guests, tg_id: tgId }) });
-                const d = await r.json();
-                currentPartyId = d.party_id; shareLink = d.share_link;
-                document.getElementById('share-link').textContent = shareLink;
-                showScreen('share');
-            } catch (e) { alert('Ошибка: ' + e.message); btn.textContent = 'Создать приглашения 🎉'; btn.disabled = false; }
-        }
-        function copyLink() {
-            navigator.clipboard.writeText(shareLink);
-            const b = document.querySelector('.btn-copy'); b.textContent = '✅ Скопировано!';
-            setTimeout(() => b.textContent = '📋 Скопировать ссылку', 2000);
-        }
-        function testInvite() {
-            document.getElementById('select-title').textContent = `${birthdayKid} приглашает тебя на День Рождения!`;
-            renderGuestButtons(); showScreen('select');
-        }
-        async function selectGuest(name) {
-            const btns = document.querySelectorAll('.guest-btn');
-            btns.forEach(b => { if (b.textContent === name) { b.textContent = '⏳ Рокки готовит приглашение...'; b.classList.add('loading'); }});
-            try {
-                if (currentPartyId && tgId) await fetch('/api/claim', { method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({ party_id: currentPartyId, guest_name: name, tg_id: tgId }) });
-                const r = await fetch('/api/generate-audio', { method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({ guest_name: name, birthday_kid: birthdayKid }) });
-                if (r.ok) {
-                    const blob = await r.blob(), url = URL.createObjectURL(blob);
-                    document.getElementById('audio-player').src = url;
-                    document.getElementById('invite-title').textContent = `Привет, ${name}!`;
-                    showScreen('invite');
-                } else alert('Ошибка генерации аудио');
-            } catch (e) { alert('Ошибка: ' + e.message); }
-            btns.forEach(b => { if (b.textContent.includes('⏳')) { b.textContent = name; b.classList.remove('loading'); }});
-        }
-        function playAudio() { document.getElementById('audio-player').play(); }
-        function showTask() { document.getElementById('task-btn').classList.add('hidden'); document.getElementById('task-card').classList.remove('hidden'); }
-        function showScreen(n) { ['setup','share','select','invite'].forEach(s => document.getElementById(`screen-${s}`).classList.add('hidden'));
-            document.getElementById(`screen-${n}`).classList.remove('hidden'); }
-    </script>
+    <script src="__SCRIPT_URL__"></script>
 </body>
 </html>
 '''
+
+STYLE_CONTENT = '''
+* { box-sizing: border-box; margin: 0; padding: 0; }
+body { font-family: system-ui, sans-serif; min-height: 100vh;
+    background: linear-gradient(135deg, #1a1a2e 0%, #16213e 100%); padding: 20px; }
+.container { max-width: 400px; margin: 0 auto; }
+.card { background: rgba(255,255,255,0.1); border-radius: 20px; padding: 24px;
+    backdrop-filter: blur(10px); margin-bottom: 16px; }
+.header { text-align: center; margin-bottom: 24px; }
+.emoji { font-size: 48px; margin-bottom: 8px; }
+.emoji-large { font-size: 64px; margin-bottom: 16px; }
+h1 { color: #fff; font-size: 22px; }
+h2 { color: #fff; font-size: 18px; margin-bottom: 16px; }
+p { color: rgba(255,255,255,0.7); font-size: 14px; margin-top: 8px; line-height: 1.5; }
+label { color: rgba(255,255,255,0.9); font-size: 14px; display: block; margin-bottom: 8px; }
+input { width: 100%; padding: 12px 16px; border-radius: 12px; border: none;
+    font-size: 16px; background: rgba(255,255,255,0.9); }
+.input-row { display: flex; gap: 8px; }
+.input-row input { flex: 1; }
+.btn { padding: 16px; border-radius: 12px; border: none; font-size: 16px;
+    cursor: pointer; width: 100%; font-weight: 600; }
+.btn-primary { background: linear-gradient(135deg, #ff6b35 0%, #f7931e 100%); color: #fff; }
+.btn-add { padding: 12px 20px; width: auto; background: #ff6b35; color: #fff; }
+.btn-secondary { background: rgba(255,107,53,0.1); border: 2px solid rgba(255,107,53,0.5); color: #fff; }
+.btn-play { padding: 16px 32px; border-radius: 50px; width: auto;
+    margin: 20px auto 0; display: flex; align-items: center; gap: 8px; font-size: 18px; }
+.btn-back { background: transparent; color: rgba(255,255,255,0.5); font-size: 14px; padding: 12px; }
+.btn:disabled { background: rgba(255,255,255,0.2); cursor: not-allowed; }
+.guests { margin: 20px 0; }
+.guests-label { color: rgba(255,255,255,0.7); font-size: 13px; margin-bottom: 8px; }
+.guest-tags { display: flex; flex-wrap: wrap; gap: 8px; }
+.guest-tag { background: rgba(255,107,53,0.3); color: #fff; padding: 8px 12px;
+    border-radius: 20px; font-size: 14px; display: flex; align-items: center; gap: 8px; }
+.guest-tag span { cursor: pointer; opacity: 0.7; }
+.guest-btn { padding: 16px 20px; margin-bottom: 12px; font-size: 18px; }
+.field { margin-bottom: 20px; }
+.task-placeholder { background: linear-gradient(135deg, #2a2a4a 0%, #1a1a3a 100%);
+    border-radius: 12px; padding: 40px 20px; text-align: center; margin-bottom: 16px; }
+.loading { opacity: 0.7; pointer-events: none; }
+.hidden { display: none; }
+.share-link { background: rgba(255,255,255,0.1); border-radius: 12px; padding: 16px;
+    word-break: break-all; color: #fff; font-size: 14px; margin: 16px 0; }
+.btn-copy { background: #4CAF50; margin-top: 8px; }
+'''
+
+SCRIPT_CONTENT = '''
+const tg = window.Telegram?.WebApp;
+if (tg) tg.expand();
+const urlParams = new URLSearchParams(window.location.search);
+const partyId = urlParams.get('party');
+const tgId = urlParams.get('tg_id') || tg?.initDataUnsafe?.user?.id || 0;
+let guests = [], birthdayKid = '', currentPartyId = partyId, shareLink = '', previewOnly = false;
+if (partyId) loadParty(partyId);
+async function loadParty(id) {
+    try {
+        const r = await fetch(`/api/party/${id}`);
+        if (r.ok) {
+            const d = await r.json();
+            birthdayKid = d.birthday_kid;
+            guests = d.guests.map(g => g.name);
+            document.getElementById('select-title').textContent = `${birthdayKid} приглашает тебя на День Рождения!`;
+            renderGuestButtons();
+            showScreen('select');
+        }
+    } catch (e) { console.error(e); }
+}
+function renderGuestButtons() {
+    document.getElementById('guest-buttons').innerHTML = guests.map(g =>
+        `<button class="btn btn-secondary guest-btn" onclick="selectGuest('${g}')">${g}</button>`).join('');
+}
+document.getElementById('new-guest')?.addEventListener('keypress', e => { if (e.key === 'Enter') addGuest(); });
+function addGuest() {
+    const i = document.getElementById('new-guest'), n = i.value.trim();
+    if (n && !guests.includes(n)) { guests.push(n); i.value = ''; renderGuests(); }
+}
+function removeGuest(n) { guests = guests.filter(g => g !== n); renderGuests(); }
+function renderGuests() {
+    const c = document.getElementById('guests-container'), l = document.getElementById('guests-list'),
+          cnt = document.getElementById('guests-count'), btn = document.getElementById('create-btn'),
+          kid = document.getElementById('birthday-kid').value.trim();
+    if (guests.length > 0) {
+        c.classList.remove('hidden'); cnt.textContent = guests.length;
+        l.innerHTML = guests.map(g => `<div class="guest-tag">${g}<span onclick="removeGuest('${g}')">✕</span></div>`).join('');
+    } else c.classList.add('hidden');
+    btn.disabled = !(guests.length > 0 && kid);
+}
+document.getElementById('birthday-kid')?.addEventListener('input', renderGuests);
+async function createParty() {
+    birthdayKid = document.getElementById('birthday-kid').value.trim();
+    const btn = document.getElementById('create-btn');
+    btn.textContent = '⏳ Создаём...'; btn.disabled = true;
+    try {
+        const r = await fetch('/api/party', { method: 'POST', headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ birthday_kid: birthdayKid, guests, tg_id: tgId }) });
+        const d = await r.json();
+        currentPartyId = d.party_id; shareLink = d.share_link;
+        document.getElementById('share-link').textContent = shareLink;
+        showScreen('share');
+    } catch (e) { alert('Ошибка: ' + e.message); btn.textContent = 'Создать приглашения 🎉'; btn.disabled = false; }
+}
+function copyLink() {
+    navigator.clipboard.writeText(shareLink);
+    const b = document.querySelector('.btn-copy'); b.textContent = '✅ Скопировано!';
+    setTimeout(() => b.textContent = '📋 Скопировать ссылку', 2000);
+}
+function testInvite() {
+    previewOnly = true;  // the organizer is looking, not claiming names
+    document.getElementById('select-title').textContent = `${birthdayKid} приглашает тебя на День Рождения!`;
+    renderGuestButtons(); showScreen('select');
+}
+async function selectGuest(name) {
+    const btns = document.querySelectorAll('.guest-btn');
+    btns.forEach(b => { if (b.textContent === name) { b.textContent = '⏳ Рокки готовит приглашение...'; b.classList.add('loading'); }});
+    try {
+        // One round trip: the claim and the audio come back in the same response.
+        const r = currentPartyId
+            ? await fetch('/api/claim-and-render', { method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ party_id: currentPartyId, guest_name: name, tg_id: previewOnly ? 0 : (tgId || 0), stream: true }) })
+            : await fetch('/api/generate-audio', { method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ guest_name: name, birthday_kid: birthdayKid, stream: true }) });
+        if (r.status === 409) alert('Это имя уже выбрал другой гость 😕');
+        else if (r.ok) {
+            await loadAudio(r);
+            document.getElementById('invite-title').textContent = `Привет, ${name}!`;
+            showScreen('invite');
+        } else alert('Ошибка генерации аудио');
+    } catch (e) { alert('Ошибка: ' + e.message); }
+    btns.forEach(b => { if (b.textContent.includes('⏳')) { b.textContent = name; b.classList.remove('loading'); }});
+}
+async function loadAudio(r) {
+    // Feed the response into the player as it arrives; fall back to a blob without MSE.
+    const player = document.getElementById('audio-player');
+    if (!r.body || !window.MediaSource || !MediaSource.isTypeSupported('audio/mpeg')) {
+        player.src = URL.createObjectURL(await r.blob()); return;
+    }
+    const ms = new MediaSource(), reader = r.body.getReader();
+    player.src = URL.createObjectURL(ms);
+    await new Promise(res => ms.addEventListener('sourceopen', res, { once: true }));
+    const sb = ms.addSourceBuffer('audio/mpeg');
+    const append = c => new Promise(res => { sb.addEventListener('updateend', res, { once: true }); sb.appendBuffer(c); });
+    let chunk = await reader.read();
+    if (!chunk.done) await append(chunk.value);
+    (async () => {
+        while (!chunk.done) { chunk = await reader.read(); if (!chunk.done) await append(chunk.value); }
+        if (ms.readyState === 'open') ms.endOfStream();
+    })().catch(e => console.error(e));
+}
+function playAudio() { document.getElementById('audio-player').play(); }
+function showTask() { document.getElementById('task-btn').classList.add('hidden'); document.getElementById('task-card').classList.remove('hidden'); }
+function showScreen(n) { ['setup','share','select','invite'].forEach(s => document.getElementById(`screen-${s}`).classList.add('hidden'));
+    document.getElementById(`screen-${n}`).classList.remove('hidden'); }
+'''
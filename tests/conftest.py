@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="rocky-tests-"), "parties.db"))
+os.environ.setdefault("AUDIO_CACHE_DIR", tempfile.mkdtemp(prefix="rocky-tests-audio-"))
+os.environ.setdefault("PRERENDER_WORKERS", "0")
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A TestClient over a fresh database, audio cache and party cache."""
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(main.db, "path", str(tmp_path / "parties.db"))
+    monkeypatch.setattr(main, "audio_cache", main.AudioCache(str(tmp_path / "audio"), 1 << 20, 1 << 24, 3600))
+    monkeypatch.setattr(main, "party_cache", main.PartyCache(100, 300, 30))
+    monkeypatch.setattr(main, "prerenderer", main.Prerenderer(0))
+    with TestClient(main.app) as tc:
+        yield tc
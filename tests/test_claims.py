@@ -0,0 +1,66 @@
+import httpx
+
+import main
+
+
+def create_party(client, guests=("Аня", "Петя")):
+    return client.post("/api/party", json={"birthday_kid": "Миша", "guests": list(guests), "tg_id": 1}).json()["party_id"]
+
+
+def claim(client, party_id, name, tg_id):
+    return client.post("/api/claim", json={"party_id": party_id, "guest_name": name, "tg_id": tg_id}).json()["claim"]
+
+
+def test_claim_outcomes(client):
+    party_id = create_party(client)
+    assert claim(client, party_id, "Аня", 5) == "claimed"
+    assert claim(client, party_id, "Аня", 5) == "already_claimed"
+    assert claim(client, party_id, "Аня", 6) == "taken"
+    assert claim(client, party_id, "Вова", 6) == "not_found"
+    assert claim(client, "nope", "Аня", 6) == "not_found"
+
+
+def test_claim_invalidates_cached_party(client):
+    party_id = create_party(client)
+    assert client.get(f"/api/party/{party_id}").json()["guests"][0]["claimed"] is False
+    claim(client, party_id, "Аня", 5)
+    claimed = {g["name"]: g["claimed"] for g in client.get(f"/api/party/{party_id}").json()["guests"]}
+    assert claimed == {"Аня": True, "Петя": False}
+
+
+def test_batch_claims_in_order(client):
+    party_id = create_party(client)
+    response = client.post("/api/claim/batch", json={"claims": [
+        {"party_id": party_id, "guest_name": "Аня", "tg_id": 5},
+        {"party_id": party_id, "guest_name": "Аня", "tg_id": 6},
+        {"party_id": party_id, "guest_name": "Аня", "tg_id": 5},
+        {"party_id": party_id, "guest_name": "Вова", "tg_id": 5},
+    ]})
+    assert [r["claim"] for r in response.json()["results"]] == ["claimed", "taken", "already_claimed", "not_found"]
+
+
+def test_claim_and_render(client, monkeypatch):
+    texts = []
+
+    def tts(request):
+        texts.append(main.json.loads(request.content)["text"])
+        return httpx.Response(200, content=b"mp3:" + texts[-1].encode())
+
+    monkeypatch.setattr(main, "ELEVEN_LABS_API_KEY", "key")
+    main.elevenlabs.client = httpx.AsyncClient(base_url="http://tts.test", transport=httpx.MockTransport(tts))
+    party_id = create_party(client)
+
+    def call(name, tg_id):
+        return client.post("/api/claim-and-render", json={"party_id": party_id, "guest_name": name, "tg_id": tg_id})
+
+    preview = call("Аня", 0)
+    assert preview.status_code == 200 and preview.headers["X-Claim-Status"] == "preview"
+    assert "Миша" in texts[0]  # birthday_kid comes from the party, not the client
+    first = call("Аня", 5)
+    assert first.status_code == 200 and first.headers["X-Claim-Status"] == "claimed"
+    assert first.content == preview.content
+    assert call("Аня", 5).headers["X-Claim-Status"] == "already_claimed"
+    taken = call("Аня", 6)
+    assert taken.status_code == 409 and taken.json()["claim"] == "taken"
+    assert call("Вова", 6).status_code == 404
+    assert len(texts) == 1  # the cache served every render after the first
@@ -0,0 +1,31 @@
+import main
+
+
+def test_counter_renders_mixed_status_labels():
+    counter = main.CounterMetric("rocky_test_total", "Test.", ("operation", "status"))
+    counter.inc("tts", 200)
+    counter.inc("tts", "error")
+    counter.inc("tts", 429)
+    counter.inc("tts", "200")
+    assert counter.render()[2:] == [
+        'rocky_test_total{operation="tts",status="200"} 2',
+        'rocky_test_total{operation="tts",status="429"} 1',
+        'rocky_test_total{operation="tts",status="error"} 1',
+    ]
+
+
+def test_histogram_renders_mixed_labels():
+    histogram = main.HistogramMetric("rocky_test_seconds", "Test.", ("status",), buckets=(1,))
+    histogram.observe(0.5, 200)
+    histogram.observe(2, "error")
+    lines = histogram.render()
+    assert 'rocky_test_seconds_bucket{status="200",le="1"} 1' in lines
+    assert 'rocky_test_seconds_count{status="error"} 1' in lines
+
+
+def test_metrics_endpoint_after_upstream_error(client):
+    main.upstream_responses_total.inc("telegram", "sendMessage", 200)
+    main.upstream_responses_total.inc("telegram", "sendMessage", "error")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'status="error"' in response.text
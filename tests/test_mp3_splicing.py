@@ -0,0 +1,99 @@
+import pytest
+
+import main
+
+MPEG1, MPEG2, MPEG25 = 3, 2, 0  # version bits in the frame header
+
+
+def frame(version=MPEG1, bitrate_index=9, rate_index=0, padding=0, mono=False, body=b""):
+    """One Layer III frame with a zeroed payload; `body` is written right after the header."""
+    header = bytes([0xFF, 0xE0 | version << 3 | 1 << 1 | 1, bitrate_index << 4 | rate_index << 2 | padding << 1,
+                    3 << 6 if mono else 0])
+    length, _ = main.mp3_frame(header, 0)
+    return header + body + bytes(length - 4 - len(body))
+
+
+def id3(body: bytes, footer: bool = False) -> bytes:
+    size = len(body)
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    tag = b"ID3" + bytes([4, 0, 0x10 if footer else 0]) + syncsafe + body
+    return tag + (b"3DI" + bytes([4, 0, 0x10]) + syncsafe if footer else b"")
+
+
+def test_frame_lengths():
+    assert main.mp3_frame(frame(), 0) == (417, (1, 44100, False))
+    assert main.mp3_frame(frame(padding=1), 0)[0] == 418
+    # MPEG-2 and 2.5 use 72 * bitrate / sample_rate and the low bitrate table
+    assert main.mp3_frame(frame(MPEG2, bitrate_index=8, rate_index=0), 0) == (208, (2, 22050, False))
+    assert main.mp3_frame(frame(MPEG2, bitrate_index=8, rate_index=1, mono=True), 0) == (192, (2, 24000, True))
+    assert main.mp3_frame(frame(MPEG25, bitrate_index=4, rate_index=2), 0) == (288, (2.5, 8000, False))
+
+
+def test_rejects_non_layer3_and_free_format():
+    layer2 = bytes([0xFF, 0xFD, 0x90, 0x00]) + bytes(400)
+    assert main.mp3_frame(layer2, 0) is None
+    assert main.mp3_frame(bytes([0xFF, 0xFB, 0x00, 0x00]), 0) is None  # free bitrate
+    assert main.mp3_frame(bytes([0xFF, 0xFB, 0x9C, 0x00]), 0) is None  # reserved sample rate
+    assert main.mp3_frame(bytes([0xFF, 0xFB]), 0) is None
+
+
+@pytest.mark.parametrize("footer", [False, True])
+def test_skips_id3v2(footer):
+    # the tag holds bytes that look like a frame header, so it must be skipped by its size
+    data = id3(frame()[:40] + b"title", footer) + frame() * 2
+    fmt, audio = main.mp3_audio_frames(data)
+    assert fmt == (1, 44100, False)
+    assert audio == frame() * 2
+
+
+@pytest.mark.parametrize("version, mono, offset", [
+    (MPEG1, False, 32), (MPEG1, True, 17), (MPEG2, False, 17), (MPEG2, True, 9),
+])
+def test_drops_xing_and_info_frames(version, mono, offset):
+    audio_frame = frame(version, bitrate_index=8, mono=mono)
+    for tag in (b"Xing", b"Info"):
+        header_frame = frame(version, bitrate_index=8, mono=mono, body=bytes(offset) + tag)
+        assert main.mp3_audio_frames(header_frame + audio_frame * 3)[1] == audio_frame * 3
+
+
+def test_drops_vbri_frame():
+    vbri = frame(body=bytes(32) + b"VBRI")
+    assert main.mp3_audio_frames(vbri + frame() * 2)[1] == frame() * 2
+
+
+def test_keeps_xing_lookalike_in_later_frames():
+    lookalike = frame(body=bytes(32) + b"Xing")
+    assert main.mp3_audio_frames(frame() + lookalike)[1] == frame() + lookalike
+
+
+def test_drops_torn_tail_and_id3v1():
+    data = frame() * 3 + frame()[:100]
+    assert main.mp3_audio_frames(data)[1] == frame() * 3
+    assert main.mp3_audio_frames(frame() * 2 + b"TAG" + bytes(125))[1] == frame() * 2
+
+
+def test_skips_leading_garbage():
+    assert main.mp3_audio_frames(b"\x00\x01junk" + frame())[1] == frame()
+
+
+def test_no_frames():
+    with pytest.raises(ValueError):
+        main.mp3_audio_frames(b"not an mp3 at all")
+
+
+def test_format_change_mid_stream():
+    with pytest.raises(ValueError, match="mid-stream"):
+        main.mp3_audio_frames(frame() + frame(MPEG2, bitrate_index=8))
+
+
+def test_splice():
+    first = id3(b"x") + frame(body=bytes(32) + b"Info") + frame() * 2
+    second = frame(padding=1) * 2 + frame()[:10]
+    assert main.splice_mp3([first, second]) == frame() * 2 + frame(padding=1) * 2
+
+
+def test_splice_rejects_mismatched_formats():
+    with pytest.raises(ValueError, match="different formats"):
+        main.splice_mp3([frame() * 2, frame(rate_index=1) * 2])
+    with pytest.raises(ValueError, match="different formats"):
+        main.splice_mp3([frame() * 2, frame(mono=True) * 2])
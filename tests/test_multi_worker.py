@@ -0,0 +1,165 @@
+import asyncio
+import sqlite3
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "parties.db")
+    monkeypatch.setattr(main.db, "path", path)
+    return path
+
+
+def test_single_process_mode_refuses_a_second_process(db_path, monkeypatch):
+    monkeypatch.setattr(main, "WORKERS", 1)
+    fd, alone = main.lock_processes(wait=0)
+    assert alone
+    try:
+        with pytest.raises(RuntimeError, match="WEB_CONCURRENCY"):
+            main.lock_processes(wait=0)
+        monkeypatch.setattr(main, "WORKERS", 4)
+        with pytest.raises(RuntimeError):
+            main.lock_processes(wait=0)
+    finally:
+        main.os.close(fd)
+
+
+def test_workers_share_the_lock(db_path, monkeypatch):
+    monkeypatch.setattr(main, "WORKERS", 2)
+    (first, first_alone), (second, second_alone) = main.lock_processes(wait=0), main.lock_processes(wait=0)
+    fds = [first, second]
+    assert (first_alone, second_alone) == (True, False)
+    try:
+        monkeypatch.setattr(main, "WORKERS", 1)
+        with pytest.raises(RuntimeError):
+            main.lock_processes(wait=0)
+    finally:
+        for fd in fds:
+            main.os.close(fd)
+
+
+def test_migrates_legacy_schema(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE parties (id TEXT PRIMARY KEY, birthday_kid TEXT, created_by_tg_id INTEGER)")
+    conn.execute("CREATE TABLE guests (id INTEGER PRIMARY KEY AUTOINCREMENT, party_id TEXT, name TEXT, "
+                 "claimed_by_tg_id INTEGER, claimed_at TIMESTAMP)")
+    conn.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, payload TEXT)")
+    conn.execute("INSERT INTO outbox (chat_id, payload) VALUES (1, '{}')")
+    conn.commit()
+    conn.close()
+    main.init_db()
+    main.init_db()  # a second worker finds nothing to do
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(main.SCHEMA_MIGRATIONS)
+    assert conn.execute("SELECT chat_id, leased_by, lease_until FROM outbox").fetchall() == [(1, None, None)]
+    conn.close()
+
+
+def test_progress_is_visible_to_every_worker(db_path):
+    async def scenario():
+        main.init_db()
+        main.db.open()
+        try:
+            await main.create_party("p1", "Миша", ["Аня", "Петя"], 1)
+            await main.db.write(main._count_prerender, "p1", "ready")
+            other_worker = main.Prerenderer(0)
+            return await other_worker.status("p1"), await other_worker.status("p2")
+        finally:
+            main.db.close()
+
+    status, missing = asyncio.run(scenario())
+    assert status == {"total": 2, "ready": 1, "failed": 0, "pending": 1, "done": False, "tracked": True}
+    assert missing is None
+
+
+def test_party_cache_picks_up_other_workers_writes(db_path, monkeypatch):
+    cache = main.PartyCache(100, 300, 30, sync_interval=0.05)
+    monkeypatch.setattr(main, "party_cache", cache)
+
+    async def scenario():
+        main.init_db()
+        main.db.open()
+        await cache.start()
+        try:
+            await main.create_party("p1", "Миша", ["Аня"], 1)
+            assert (await main.get_party("p1"))["guests"][0]["claimed"] is False
+            # another worker claims the guest and records the invalidation in its transaction
+            conn = sqlite3.connect(db_path)
+            conn.execute("UPDATE guests SET claimed_by_tg_id = 5")
+            conn.execute("INSERT INTO cache_invalidations (party_id, worker_id, created_at) VALUES ('p1', 'w2', ?)",
+                         (time.time(),))
+            conn.commit()
+            conn.close()
+            assert (await main.get_party("p1"))["guests"][0]["claimed"] is False  # still cached
+            await asyncio.sleep(0.2)
+            return await main.get_party("p1")
+        finally:
+            await cache.stop()
+            main.db.close()
+
+    assert asyncio.run(scenario())["guests"][0]["claimed"] is True
+    assert cache.remote_invalidations == 1
+
+
+def test_single_process_replays_the_whole_outbox(db_path, monkeypatch):
+    sent = []
+
+    def transport(request):
+        sent.append(main.json.loads(request.content)["text"])
+        return httpx.Response(200, json={"ok": True})
+
+    async def scenario():
+        main.init_db()
+        main.db.open()
+        telegram = main.UpstreamClient("telegram", "http://telegram.test", 5.0)
+        telegram.open()
+        telegram.client = httpx.AsyncClient(base_url="http://telegram.test", transport=httpx.MockTransport(transport))
+        monkeypatch.setattr(main, "telegram", telegram)
+        # 250 sends left behind by a previous run, some still under its lease
+        for i in range(250):
+            await main.db.write(main._outbox_add, 1000 + i, main.json.dumps({"chat_id": 1000 + i, "text": str(i)}),
+                                "previous-run", time.time() + 3600 if i % 2 else None)
+        dispatcher = main.TelegramDispatcher(8, 1000.0, 100.0, 3, persist=True, poll_interval=0.05)
+        await dispatcher.start()
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                if len(sent) == 250:
+                    break
+            return await main.db.run(lambda conn: conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0])
+        finally:
+            await dispatcher.stop()
+            await telegram.client.aclose()
+            main.db.close()
+
+    left = asyncio.run(scenario())
+    assert sorted(map(int, sent)) == list(range(250))
+    assert left == 0
+
+
+def test_first_process_resumes_unfinished_prerenders(db_path, monkeypatch):
+    async def scenario():
+        main.init_db()
+        main.db.open()
+        try:
+            await main.create_party("p1", "Миша", ["Аня", "Петя"], 1)
+            await main.create_party("p2", "Оля", ["Дима"], 1)
+            # the previous run rendered one of p1's guests and all of p2 before it died
+            await main.db.write(main._count_prerender, "p1", "ready")
+            await main.db.write(main._count_prerender, "p2", "failed")
+            prerenderer = main.Prerenderer(0)
+            await prerenderer.resume()
+            queued = [prerenderer.queue.get_nowait() for _ in range(prerenderer.queue.qsize())]
+            return queued, await prerenderer.statuses(["p1", "p2"])
+        finally:
+            main.db.close()
+
+    queued, statuses = asyncio.run(scenario())
+    assert sorted(queued) == [("p1", "Аня", "Миша"), ("p1", "Петя", "Миша")]
+    assert (statuses["p1"]["ready"], statuses["p1"]["pending"]) == (0, 2)
+    assert statuses["p2"]["done"] and statuses["p2"]["failed"] == 1
@@ -0,0 +1,35 @@
+import main
+
+
+def create_party(client, guests=("Аня", "Петя")):
+    response = client.post("/api/party", json={"birthday_kid": "Миша", "guests": list(guests), "tg_id": 1})
+    assert response.status_code == 200
+    return response.json()["party_id"]
+
+
+def test_audio_status_tracked_party(client):
+    party_id = create_party(client)
+    status = client.get(f"/api/party/{party_id}/audio-status").json()
+    assert status == {"total": 2, "ready": 0, "failed": 0, "pending": 2, "done": False, "tracked": True}
+
+
+def test_audio_status_untracked_party(client):
+    party_id = create_party(client)
+    with main.sqlite3.connect(main.db.path) as conn:  # as for a party from before progress was tracked
+        conn.execute("DELETE FROM prerender_progress")
+    response = client.get(f"/api/party/{party_id}/audio-status")
+    assert response.status_code == 200
+    assert response.json()["tracked"] is False
+    assert response.json()["total"] == 2
+    assert response.json()["done"] is None
+
+
+def test_audio_status_unknown_party(client):
+    assert client.get("/api/party/nope/audio-status").status_code == 404
+
+
+def test_batch_status_reports_audio_progress(client):
+    party_id = create_party(client)
+    results = client.post("/api/parties/status", json={"party_ids": [party_id, "nope", party_id]}).json()["results"]
+    assert [r["status"] for r in results] == ["found", "not_found", "found"]
+    assert results[0]["audio"]["pending"] == 2 and results[1]["audio"] is None
@@ -0,0 +1,71 @@
+import main
+
+
+def test_hit_miss_and_negative_entries(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    cache = main.PartyCache(10, ttl=300, negative_ttl=30)
+    assert cache.get("p1") == (False, None)
+    cache.put("p1", {"birthday_kid": "Миша"}, cache.generation)
+    cache.put("gone", None, cache.generation)
+    assert cache.get("p1") == (True, {"birthday_kid": "Миша"})
+    assert cache.get("gone") == (True, None)
+    clock[0] += 31
+    assert cache.get("gone") == (False, None)  # unknown IDs expire sooner
+    assert cache.get("p1")[0] is True
+    clock[0] += 300
+    assert cache.get("p1") == (False, None)
+    assert (cache.hits, cache.negative_hits, cache.misses) == (2, 1, 3)
+
+
+def test_put_after_racing_invalidation_is_dropped():
+    cache = main.PartyCache(10, 300, 30)
+    generation = cache.generation  # a read starts
+    cache.invalidate("p1")  # a write commits meanwhile
+    cache.put("p1", {"stale": True}, generation)
+    assert cache.get("p1") == (False, None)
+    cache.put("p1", {"stale": False}, cache.generation)
+    assert cache.get("p1") == (True, {"stale": False})
+
+
+def test_invalidation_of_another_party_also_drops_racing_puts():
+    # Generations are global, which is conservative but never serves stale data.
+    cache = main.PartyCache(10, 300, 30)
+    generation = cache.generation
+    cache.invalidate("p2")
+    cache.put("p1", {}, generation)
+    assert cache.get("p1") == (False, None)
+
+
+def test_lru_eviction():
+    cache = main.PartyCache(2, 300, 30)
+    for party_id in ("a", "b"):
+        cache.put(party_id, {}, cache.generation)
+    cache.get("a")  # "b" is now least recently used
+    cache.put("c", {}, cache.generation)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a")[0] and cache.get("c")[0]
+    assert cache.evictions == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = main.PartyCache(0, 300, 30)
+    cache.put("a", {}, cache.generation)
+    assert cache.get("a") == (False, None)
+
+
+def test_clear_drops_entries_and_racing_puts():
+    cache = main.PartyCache(10, 300, 30)
+    cache.put("a", {}, cache.generation)
+    generation = cache.generation
+    cache.clear()
+    cache.put("b", {}, generation)
+    assert cache.get("a") == (False, None) and cache.get("b") == (False, None)
+
+
+def test_create_invalidates_negative_entry(client, monkeypatch):
+    assert client.get("/api/party/abc").status_code == 404
+    assert main.party_cache.get("abc") == (True, None)
+    monkeypatch.setattr(main, "new_party_id", lambda: "abc")
+    client.post("/api/party", json={"birthday_kid": "Миша", "guests": ["Аня"], "tg_id": 1})
+    assert client.get("/api/party/abc").status_code == 200
@@ -0,0 +1,81 @@
+import json
+
+import main
+
+
+def chunked(text: str, size: int = 7):
+    data = text.encode()
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def test_batch_validates_like_import(client):
+    response = client.post("/api/parties/batch", json={"parties": [
+        {"birthday_kid": "Миша", "guests": ["Аня"], "tg_id": 1},
+        {"birthday_kid": " ", "guests": ["Аня"], "tg_id": 1},
+        {"birthday_kid": "Оля", "guests": [" "], "tg_id": 1},
+    ]})
+    results = response.json()["results"]
+    assert [r["status"] for r in results] == ["created", "error", "error"]
+    assert [r["index"] for r in results] == [0, 1, 2]
+    assert client.get(f"/api/party/{results[0]['party_id']}").json()["guests"] == [{"name": "Аня", "claimed": False}]
+
+
+def test_import_reports_long_line_and_continues(client, monkeypatch):
+    monkeypatch.setattr(main, "IMPORT_MAX_LINE", 100)
+    monkeypatch.setattr(main, "IMPORT_BATCH_SIZE", 1)
+    lines = [
+        json.dumps({"birthday_kid": "A", "guests": ["x"], "tg_id": 1}),
+        json.dumps({"birthday_kid": "B", "guests": ["y" * 200], "tg_id": 1}),
+        json.dumps({"birthday_kid": "C", "guests": ["z"], "tg_id": 1}),
+        json.dumps({"birthday_kid": "D", "guests": ["w" * 200], "tg_id": 1}),
+    ]
+    response = client.post("/api/parties/import", content=chunked("\n".join(lines)),
+                           headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(r["line"], r["status"]) for r in results] == [(1, "created"), (2, "error"), (3, "created"), (4, "error")]
+    assert results[1]["error"] == "Line too long"
+
+
+def test_import_csv_with_multiline_quoted_field(client):
+    body = ('birthday_kid,tg_id,guests\r\n'
+            '"Миша, младший",5,"Аня\r\nПетя;Вова"\r\n'
+            'Оля,,Дима\r\n'
+            'Катя,,"unclosed\r\n')
+    response = client.post("/api/parties/import", content=chunked(body, 5), headers={"Content-Type": "text/csv"})
+    results = response.json()["results"]
+    assert [(r["line"], r["status"]) for r in results] == [(2, "created"), (4, "created"), (5, "error")]
+    party = client.get(f"/api/party/{results[0]['party_id']}").json()
+    assert party["birthday_kid"] == "Миша, младший"
+    assert sorted(g["name"] for g in party["guests"]) == ["Аня", "Вова", "Петя"]
+
+
+def test_import_csv_rejects_empty_rows(client):
+    body = "birthday_kid,guests\n,Аня\nМиша,\nМиша,Аня\n"
+    response = client.post("/api/parties/import", content=body, headers={"Content-Type": "text/csv"})
+    assert [r["status"] for r in response.json()["results"]] == ["error", "error", "created"]
+
+
+def test_import_csv_quote_inside_unquoted_field_is_literal(client):
+    body = 'birthday_kid,guests\nMi"sha,Anna\nKate,Bob\n'
+    response = client.post("/api/parties/import", content=body, headers={"Content-Type": "text/csv"})
+    results = response.json()["results"]
+    assert [(r["line"], r["status"]) for r in results] == [(2, "created"), (3, "created")]
+    assert client.get(f"/api/party/{results[0]['party_id']}").json()["birthday_kid"] == 'Mi"sha'
+
+
+def test_import_csv_quoted_field_after_literal_quote(client):
+    body = 'birthday_kid,guests\nx"y,"z\nKate,Bob\n'
+    response = client.post("/api/parties/import", content=body, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    assert [(r["line"], r["status"], r["error"]) for r in response.json()["results"]] == [
+        (2, "error", "Unclosed quote at end of file")]
+
+
+def test_csv_quote_open_follows_the_csv_dialect():
+    assert not main.csv_quote_open('a,"b ""c"", d",e')
+    assert main.csv_quote_open('a,"b')
+    assert not main.csv_quote_open('a"b,c"')
+    assert not main.csv_quote_open('end",x', quoted=True)
+    assert main.csv_quote_open('still ""open', quoted=True)
@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_concurrent_calls_share_one_execution():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return b"audio"
+
+    async def scenario():
+        flight = main.SingleFlight()
+        results = await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+        return flight, results
+
+    flight, results = asyncio.run(scenario())
+    assert results == [b"audio"] * 5
+    assert len(calls) == 1
+    assert (flight.leaders, flight.coalesced) == (1, 4)
+    assert "k" not in flight and flight.stats()["inflight"] == 0
+
+
+def test_sequential_calls_run_again():
+    async def scenario():
+        flight = main.SingleFlight()
+        counter = iter(range(10))
+
+        async def fetch():
+            return next(counter)
+
+        return [await flight.do("k", fetch) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == [0, 1, 2]
+
+
+def test_errors_reach_every_waiter():
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream down")
+
+    async def scenario():
+        flight = main.SingleFlight()
+        return await asyncio.gather(*(flight.do("k", fetch) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_abandoned_flight_is_retried():
+    attempts = []
+
+    async def fetch():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        if len(attempts) == 1:
+            raise asyncio.CancelledError()
+        return "second"
+
+    async def scenario():
+        flight = main.SingleFlight()
+        return await asyncio.gather(flight.do("k", fetch), flight.do("k", fetch))
+
+    assert asyncio.run(scenario()) == ["second", "second"]
+    assert len(attempts) == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_flight():
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def scenario():
+        flight = main.SingleFlight()
+        impatient = asyncio.create_task(flight.do("k", fetch))
+        patient = asyncio.create_task(flight.do("k", fetch))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        return await patient, flight.leaders
+
+    assert asyncio.run(scenario()) == ("done", 1)
+
+
+def test_lock_is_a_noop_without_lock_dir():
+    async def scenario():
+        async with main.SingleFlight().lock("ab" * 32):
+            return True
+
+    assert asyncio.run(scenario())
+
+
+def test_cross_process_lock_serializes_holders(tmp_path):
+    key = "0123abcd" * 8
+    order = []
+
+    async def hold(flight, name):
+        async with flight.lock(key):
+            order.append(f"{name} in")
+            await asyncio.sleep(0.1)
+            order.append(f"{name} out")
+
+    async def scenario():
+        # two instances stand in for two worker processes: flock locks per open file
+        first, second = main.SingleFlight(str(tmp_path)), main.SingleFlight(str(tmp_path))
+        task = asyncio.create_task(hold(first, "a"))
+        await asyncio.sleep(0.02)
+        await hold(second, "b")
+        await task
+        return second
+
+    second = asyncio.run(scenario())
+    assert order == ["a in", "a out", "b in", "b out"]
+    assert second.lock_waits == 1
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_render_rechecks_shared_cache_inside_lock(monkeypatch, tmp_path, cached):
+    flight = main.SingleFlight(str(tmp_path))
+    monkeypatch.setattr(main, "synthesis_flight", flight)
+    fetched = []
+
+    async def fetch_tts(payload):
+        fetched.append(payload)
+        return b"fresh"
+
+    async def get_cached_audio(key):
+        return b"from another worker" if cached else None
+
+    monkeypatch.setattr(main, "fetch_tts", fetch_tts)
+    monkeypatch.setattr(main, "get_cached_audio", get_cached_audio)
+    monkeypatch.setattr(main, "audio_cache", main.AudioCache(str(tmp_path / "audio"), 1 << 20, 1 << 20, 3600))
+    monkeypatch.setattr(main, "upstream_limiters", {})
+    audio = asyncio.run(main.render_audio({"text": "x"}, "ab" * 32))
+    assert audio == (b"from another worker" if cached else b"fresh")
+    assert len(fetched) == (0 if cached else 1)
+    assert flight.shared_hits == (1 if cached else 0)
@@ -0,0 +1,77 @@
+import gzip
+import re
+
+import main
+
+
+def test_accepted_encodings():
+    assert main.accepted_encodings("gzip, deflate, br") == {"gzip": 1.0, "deflate": 1.0, "br": 1.0}
+    assert main.accepted_encodings("GZIP;q=0.5, br ; q=0, *;q=0.1") == {"gzip": 0.5, "br": 0.0, "*": 0.1}
+    assert main.accepted_encodings("gzip;q=oops") == {"gzip": 0.0}
+    assert main.StaticAsset(b"a" * 1000, "text/plain").pick_encoding("gzip ;q=0, *") != "gzip"
+    assert main.accepted_encodings("") == {}
+
+
+def test_pick_encoding():
+    asset = main.StaticAsset(b"body { color: red; }\n" * 50, "text/css")
+    asset.variants.pop("br", None)  # independent of whether brotli is installed
+    assert asset.pick_encoding("gzip, br") == "gzip"
+    assert asset.pick_encoding("br") == "identity"
+    assert asset.pick_encoding("*") == "gzip"
+    assert asset.pick_encoding("*, gzip;q=0") == "identity"
+    assert asset.pick_encoding("identity") == "identity"
+    assert asset.pick_encoding("") == "identity"
+
+
+def test_tiny_body_is_not_compressed():
+    asset = main.StaticAsset(b"x", "text/plain")
+    assert asset.pick_encoding("gzip, br") == "identity"
+
+
+def test_etags_are_per_encoding():
+    asset = main.StaticAsset(b"a" * 1000, "text/plain")
+    assert len(set(asset.etags.values())) == len(asset.variants)
+    assert all(tag.startswith('"') and tag.endswith(f'-{coding}"') for coding, tag in asset.etags.items())
+
+
+def test_index_is_compressed_and_revalidated(client):
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    etag = response.headers["ETag"]
+    assert etag.endswith('-gzip"')
+    assert "__SCRIPT_URL__" not in response.text
+
+    for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        revalidated = client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": if_none_match})
+        assert revalidated.status_code == 304
+        assert revalidated.content == b""
+        assert revalidated.headers["ETag"] == etag
+    assert client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": '"other"'}).status_code == 200
+
+
+def test_other_encodings_etag_does_not_revalidate(client):
+    gzip_etag = client.get("/", headers={"Accept-Encoding": "gzip"}).headers["ETag"]
+    response = client.get("/", headers={"Accept-Encoding": "identity", "If-None-Match": gzip_etag})
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["ETag"].endswith('-identity"')
+    assert client.get("/", headers={"Accept-Encoding": "identity",
+                                    "If-None-Match": response.headers["ETag"]}).status_code == 304
+
+
+def test_assets_are_fingerprinted_and_immutable(client):
+    html = client.get("/", headers={"Accept-Encoding": "identity"}).text
+    script_url = re.search(r'src="(/assets/app\.[0-9a-f]{12}\.js)"', html).group(1)
+    style_url = re.search(r'href="(/assets/app\.[0-9a-f]{12}\.css)"', html).group(1)
+    for url, source in ((script_url, main.SCRIPT_CONTENT), (style_url, main.STYLE_CONTENT)):
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+        assert response.text == source
+    script = main.static_assets[script_url.rsplit("/", 1)[1]]
+    assert gzip.decompress(script.variants["gzip"]) == script.variants["identity"]
+    assert client.get("/assets/index.html").status_code == 404
+    assert client.get("/assets/app.000000000000.js").status_code == 404
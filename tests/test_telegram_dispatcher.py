@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import httpx
+
+import main
+
+
+def run_dispatcher(monkeypatch, handler, sends, chat_rate=1.0, gap=0.0, timeout=5.0):
+    """Push `sends` through a fresh dispatcher; returns {text: monotonic time it reached Telegram}."""
+    delivered = {}
+
+    def transport(request):
+        text = main.json.loads(request.content)["text"]
+        response = handler(text)
+        if response.status_code == 200:
+            delivered[text] = time.monotonic()
+        return response
+
+    async def scenario():
+        telegram = main.UpstreamClient("telegram", "http://telegram.test", 5.0)
+        telegram.open()
+        telegram.client = httpx.AsyncClient(base_url="http://telegram.test", transport=httpx.MockTransport(transport))
+        monkeypatch.setattr(main, "telegram", telegram)
+        dispatcher = main.TelegramDispatcher(8, 100.0, chat_rate, 3, persist=False)
+        await dispatcher.start()
+        started = time.monotonic()
+        for chat_id, text in sends:
+            await dispatcher.send(chat_id, {"chat_id": chat_id, "text": text})
+            await asyncio.sleep(gap)
+        await dispatcher.stop(drain_timeout=timeout)
+        await telegram.client.aclose()
+        return started, dispatcher
+
+    started, dispatcher = asyncio.run(scenario())
+    return {text: at - started for text, at in delivered.items()}, dispatcher
+
+
+def test_busy_chat_does_not_stall_other_chats(monkeypatch):
+    sends = [(1, f"a{i}") for i in range(10)] + [(2, "b")]
+    delivered, _ = run_dispatcher(monkeypatch, lambda text: httpx.Response(200, json={"ok": True}), sends,
+                                  chat_rate=20.0)
+    assert delivered["b"] < 0.1
+    # chat 1 is still paced and in order
+    times = [delivered[f"a{i}"] for i in range(10)]
+    assert times == sorted(times)
+    assert times[-1] >= 9 * 0.05 * 0.9
+
+
+def test_rate_limit_holds_back_every_chat(monkeypatch):
+    limited = []
+
+    def handler(text):
+        if text == "a" and not limited:
+            limited.append(text)
+            return httpx.Response(429, json={"ok": False, "parameters": {"retry_after": 1}})
+        return httpx.Response(200, json={"ok": True})
+
+    delivered, dispatcher = run_dispatcher(monkeypatch, handler, [(1, "a"), (2, "b")], gap=0.2)
+    assert dispatcher.rate_limited == 1 and dispatcher.sent == 2
+    assert delivered["a"] >= 0.9
+    assert delivered["b"] >= 0.9  # a different chat, but the same bot
+
+
+def test_gives_up_on_client_errors(monkeypatch):
+    delivered, dispatcher = run_dispatcher(monkeypatch, lambda text: httpx.Response(400, text="bad"), [(1, "a")])
+    assert delivered == {}
+    assert dispatcher.failed == 1 and dispatcher.retries == 0
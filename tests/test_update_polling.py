@@ -0,0 +1,71 @@
+import asyncio
+import sqlite3
+
+import httpx
+import pytest
+
+import main
+
+
+def test_poller_survives_garbage(monkeypatch):
+    responses = [
+        httpx.Response(200, text="<html>bad gateway</html>"),
+        httpx.Response(200, json={"ok": True, "result": [{"message": {}}]}),
+        httpx.Response(200, json={"ok": True, "result": [{"update_id": 7, "message": {"chat": {"id": 1}}}]}),
+    ]
+    offsets, submitted = [], []
+
+    async def transport(request):
+        await asyncio.sleep(0.01)  # like a long poll, let the test loop run
+        offsets.append(main.json.loads(request.content)["offset"])
+        if responses:
+            return responses.pop(0)
+        return httpx.Response(200, json={"ok": True, "result": []})
+
+    async def submit(update, timeout=None):
+        submitted.append(update["update_id"])
+        return True
+
+    async def scenario():
+        telegram = main.UpstreamClient("telegram", "http://telegram.test", 5.0)
+        telegram.open()
+        telegram.client = httpx.AsyncClient(base_url="http://telegram.test", transport=httpx.MockTransport(transport))
+        monkeypatch.setattr(main, "telegram", telegram)
+        monkeypatch.setattr(main.update_pipeline, "submit", submit)
+        poller = asyncio.create_task(main.poll_updates())
+        for _ in range(100):
+            if submitted:
+                break
+            await asyncio.sleep(0.05)
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+        await telegram.client.aclose()
+
+    asyncio.run(scenario())
+    assert submitted == [7]
+    assert offsets[:3] == [None, None, None]
+
+
+def test_failed_dedup_write_lets_the_redelivery_through(monkeypatch):
+    calls = []
+
+    async def write(fn, *args):
+        calls.append(args[0])
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return True
+
+    monkeypatch.setattr(main.db, "write", write)
+
+    async def scenario():
+        pipeline = main.UpdatePipeline(1, 10, 100, dedup_ttl=60)
+        update = {"update_id": 9, "message": {"chat": {"id": 1}}}
+        with pytest.raises(sqlite3.OperationalError):
+            await pipeline.submit(update)
+        assert await pipeline.submit(update)
+        return pipeline
+
+    pipeline = asyncio.run(scenario())
+    assert calls == [9, 9]
+    assert pipeline.duplicates == 0
+    assert pipeline.queues[0].qsize() == 1